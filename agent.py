@@ -1,7 +1,17 @@
 # Defines the LLM agent
 
-from api_utils import get_openai_key_from_file
-from query_analysis import ThingsSearchModel, generate_url
+from api_utils import (
+    OutputStore,
+    get_openai_key_from_file,
+    get_stored_output,
+    get_thing_data,
+    output_store_scope,
+    query_usgs_sensorthings_api,
+    store_tool_output,
+)
+from rate_limiter import get_openai_async_http_client, get_openai_http_client
+from query_analysis import ThingsSearchModel, generate_url, generate_urls
+from langchain.pydantic_v1 import BaseModel
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnablePassthrough
 from langchain_openai import ChatOpenAI
@@ -11,22 +21,110 @@ from langchain.agents.format_scratchpad.openai_tools import (
     format_to_openai_tool_messages,
 )
 from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser
+from langchain_core.agents import AgentFinish
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import lru_cache, partial
+from typing import List, Optional, Union
+import asyncio
+import threading
+import tiktoken
+import time
 import os
 
 GPT_MODEL = "gpt-3.5-turbo-0613"
 
-def create_agent_executor():
-    """Initializes langchain OpenAI agent executor with llm bound to tools defined in query_analysis:
-    - generate_url
+# Maximum number of tokens of tool outputs re-sent to the LLM in the agent scratchpad
+SCRATCHPAD_MAX_TOKENS = 3000
+# Number of characters kept from a trimmed tool output
+TRIMMED_OUTPUT_CHARS = 200
+# Maximum number of synchronous tool calls of an agent run running at the same time
+MAX_TOOL_WORKERS = 8
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    """Load the tokenizer of GPT_MODEL, or None if it cannot be loaded (e.g. offline)."""
+    try:
+        return tiktoken.encoding_for_model(GPT_MODEL)
+    except Exception:
+        return None
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text for GPT_MODEL, approximating 4 characters per token when the tokenizer is unavailable.
+    Counts are cached, so the scratchpad only tokenizes each tool output once.
+    :param text: the text
+    :return: the number of tokens
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+def trim_intermediate_steps(intermediate_steps: list, max_tokens: int = SCRATCHPAD_MAX_TOKENS) -> list:
+    """
+    Keep the tool outputs of the agent scratchpad under `max_tokens`.
+    The oldest outputs are replaced first by their beginning and the handle of the stored full output,
+    which the agent can read back with get_stored_output.
+    :param intermediate_steps: the (action, observation) pairs of the agent run
+    :param max_tokens: the maximum number of observation tokens
+    :return: the trimmed (action, observation) pairs
     """
+    steps = [(action, str(observation)) for action, observation in intermediate_steps]
+    total = sum(count_tokens(observation) for _, observation in steps)
 
-    llm = ChatOpenAI(
-        api_key=get_openai_key_from_file("openai_key.txt"),
+    for i, (action, observation) in enumerate(steps):
+        if total <= max_tokens:
+            break
+        if len(observation) <= TRIMMED_OUTPUT_CHARS:
+            continue
+        handle = store_tool_output(observation)
+        trimmed = observation[:TRIMMED_OUTPUT_CHARS] + \
+            f" [trimmed, full output stored as handle '{handle}', use get_stored_output to read it]"
+        total -= count_tokens(observation) - count_tokens(trimmed)
+        steps[i] = (action, trimmed)
+
+    return steps
+
+def format_scratchpad(intermediate_steps: list, max_tokens: int = SCRATCHPAD_MAX_TOKENS) -> list:
+    """
+    Format the agent scratchpad as OpenAI tool messages, trimming old tool outputs to stay under `max_tokens`.
+    :param intermediate_steps: the (action, observation) pairs of the agent run
+    :param max_tokens: the maximum number of observation tokens
+    :return: the scratchpad messages
+    """
+    return format_to_openai_tool_messages(trim_intermediate_steps(intermediate_steps, max_tokens))
+
+def create_llm(api_key: Optional[str] = None) -> ChatOpenAI:
+    """
+    Initializes the langchain OpenAI chat model. Its calls go through the process-wide HTTP clients and openai rate limiter,
+    which also handles retries.
+    :param api_key: the OpenAI API key, read from openai_key.txt if None
+    :return: the chat model
+    """
+    return ChatOpenAI(
+        api_key=api_key or get_openai_key_from_file("openai_key.txt"),
         model=GPT_MODEL,
-        temperature=0
+        temperature=0,
+        max_retries=0,
+        http_client=get_openai_http_client(),
+        http_async_client=get_openai_async_http_client(),
         )
+
+def create_agent(api_key: Optional[str] = None):
+    """Initializes langchain OpenAI agent with llm bound to tools defined in query_analysis and api_utils:
+    - generate_url
+    - query_usgs_sensorthings_api
+    - get_thing_data
+    - get_stored_output
+    :param api_key: the OpenAI API key, read from openai_key.txt if None
+    :return: the agent runnable and its tools
+    """
+
+    llm = create_llm(api_key)
     
-    tools = [generate_url]
+    tools = [generate_url, query_usgs_sensorthings_api, get_thing_data, get_stored_output]
 
     prompt = ChatPromptTemplate.from_messages(
     [
@@ -46,7 +144,7 @@ def create_agent_executor():
     agent = (
     {
         "input": lambda x: x["input"],
-        "agent_scratchpad": lambda x: format_to_openai_tool_messages(
+        "agent_scratchpad": lambda x: format_scratchpad(
             x["intermediate_steps"]
         ),
     }
@@ -55,17 +153,136 @@ def create_agent_executor():
     | OpenAIToolsAgentOutputParser()
     )
 
+    return agent, tools
+
+
+def create_agent_executor():
+    """Initializes langchain OpenAI agent executor with the agent and tools of create_agent.
+    """
+
+    agent, tools = create_agent()
 
     agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
 
     return agent_executor
 
 
-def query_analysis(query: str) -> ThingsSearchModel:
+async def _arun_tool(tools_by_name: dict, action, timeout: float, executor: ThreadPoolExecutor) -> str:
     """
-    Analyze a query to search over USGS SensorThings Things.
-    :param query: the query to analyze
-    :return: a ThingsSearch object
+    Run the tool requested by an agent action, turning errors and timeouts into observations for the agent.
+    Synchronous tools run on `executor` rather than on the event loop's default executor.
+    :param tools_by_name: the available tools keyed by name
+    :param action: the agent action
+    :param timeout: the maximum number of seconds the tool may run
+    :param executor: the executor of the agent run
+    :return: the tool observation
+    """
+    tool = tools_by_name.get(action.tool)
+    if tool is None:
+        return f"{action.tool} is not a valid tool, try one of [{', '.join(tools_by_name)}]."
+    try:
+        if getattr(tool, "coroutine", None) is not None:
+            call = tool.ainvoke(action.tool_input)
+        else:
+            # The context is copied so the tool sees the output store of the run
+            call = asyncio.get_running_loop().run_in_executor(
+                executor, partial(copy_context().run, tool.invoke, action.tool_input))
+        return await asyncio.wait_for(call, timeout=timeout)
+    except asyncio.TimeoutError:
+        return f"Error: {action.tool} timed out after {timeout} seconds."
+    except Exception as e:
+        return f"Error: {e}"
+
+
+async def arun_agent(
+    input: str,
+    agent=None,
+    tools=None,
+    max_iterations: int = 10,
+    tool_timeout: float = 30.0,
+    max_latency: float = 120.0,
+    output_store: Optional[OutputStore] = None,
+) -> dict:
+    """
+    Run the agent asynchronously. Tool calls requested in the same turn run concurrently,
+    so a turn takes as long as its slowest tool call rather than the sum of them.
+    The run stops after `max_iterations` turns or `max_latency` seconds, cancelling any pending tool calls.
+    Truncated tool outputs are stored in `output_store`, so concurrent runs never read or evict each other's outputs.
+
+    Synchronous tools cannot be interrupted: a call that times out is only abandoned, and its thread keeps running
+    until the tool returns, which the HTTP timeouts of the USGS session bound. These calls run on an executor of
+    MAX_TOOL_WORKERS threads owned by the run and shut down when it ends, so abandoned calls do not pile up
+    on the event loop's default executor.
+    :param input: the user question
+    :param agent: the agent runnable, defaults to the one returned by create_agent
+    :param tools: the tools available to the agent
+    :param max_iterations: the maximum number of agent turns
+    :param tool_timeout: the maximum number of seconds a single tool call may run
+    :param max_latency: the maximum number of seconds the whole run may take
+    :param output_store: the store of truncated tool outputs, e.g. one per session; a new one per run if None
+    :return: a dict with the input, the output and the intermediate steps
+    """
+    if agent is None:
+        agent, tools = create_agent()
+    tools_by_name = {tool.name: tool for tool in tools or []}
+
+    deadline = time.monotonic() + max_latency
+    intermediate_steps = []
+    executor = ThreadPoolExecutor(max_workers=MAX_TOOL_WORKERS, thread_name_prefix="agent-tool")
+
+    with output_store_scope(output_store):
+        try:
+            for _ in range(max_iterations):
+                output = await asyncio.wait_for(
+                    agent.ainvoke({"input": input, "intermediate_steps": intermediate_steps}),
+                    timeout=deadline - time.monotonic(),
+                )
+                if isinstance(output, AgentFinish):
+                    return {
+                        "input": input,
+                        "output": output.return_values["output"],
+                        "intermediate_steps": intermediate_steps,
+                    }
+
+                actions = output if isinstance(output, list) else [output]
+                observations = await asyncio.wait_for(
+                    asyncio.gather(*[_arun_tool(tools_by_name, action, tool_timeout, executor) for action in actions]),
+                    timeout=deadline - time.monotonic(),
+                )
+                intermediate_steps.extend(zip(actions, observations))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # Queued tool calls are dropped, running ones finish in the background and their threads then exit
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    return {
+        "input": input,
+        "output": "Agent stopped due to iteration limit or time limit.",
+        "intermediate_steps": intermediate_steps,
+    }
+
+
+_thread_local = threading.local()
+
+def run_agent(input: str, **kwargs) -> dict:
+    """
+    Run the agent from synchronous code, see arun_agent.
+    Each thread reuses its own event loop, so its HTTP connections are kept alive between runs.
+    Unlike asyncio.run, the call returns without waiting for tool threads that were abandoned after a timeout.
+    :param input: the user question
+    :return: a dict with the input, the output and the intermediate steps
+    """
+    loop = getattr(_thread_local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(arun_agent(input, **kwargs))
+
+
+def create_query_analyzer():
+    """
+    Initializes the langchain chain converting a question into a ThingsSearchModel.
+    :return: the query analysis chain
     """
 
     system = """You are an expert at converting user questions into USGS SensorThings API queries. \
@@ -81,15 +298,77 @@ def query_analysis(query: str) -> ThingsSearchModel:
         ]
     )
 
-    llm = ChatOpenAI(
-        api_key=get_openai_key_from_file("openai_key.txt"),
-        model=GPT_MODEL,
-        temperature=0)
+    llm = create_llm()
 
     structured_llm = llm.with_structured_output(ThingsSearchModel)
     query_analyzer = {"question": RunnablePassthrough()} | prompt | structured_llm
+
+    return query_analyzer
+
+def query_analysis(query: str) -> ThingsSearchModel:
+    """
+    Analyze a query to search over USGS SensorThings Things.
+    :param query: the query to analyze
+    :return: a ThingsSearch object
+    """
     
-    return query_analyzer.invoke(query) 
+    return create_query_analyzer().invoke(query) 
+
+def batch_query_analysis(queries: List[str], max_concurrency: int = 8) -> List[Union[ThingsSearchModel, Exception]]:
+    """
+    Analyze a batch of queries, running at most `max_concurrency` LLM calls at the same time.
+    Identical queries (ignoring case and surrounding whitespace) are only analyzed once.
+    :param queries: the queries to analyze
+    :param max_concurrency: the maximum number of concurrent LLM calls
+    :return: a ThingsSearch object per query in input order, or the exception raised while analyzing it
+    """
+    keys = [" ".join(query.lower().split()) for query in queries]
+    unique_queries = {}
+    for key, query in zip(keys, queries):
+        unique_queries.setdefault(key, query)
+
+    results = create_query_analyzer().batch(
+        list(unique_queries.values()),
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True,
+    )
+    results_by_key = dict(zip(unique_queries.keys(), results))
+
+    return [results_by_key[key] for key in keys]
+
+class QueryBatchResult(BaseModel):
+    """
+    The outcome of converting one question of a batch into a USGS SensorThings API query.
+    """
+
+    question: str
+    search_params: Optional[ThingsSearchModel] = None
+    url: Optional[str] = None
+    error: Optional[str] = None
+
+def batch_generate_urls(queries: List[str], max_concurrency: int = 8) -> List[QueryBatchResult]:
+    """
+    Convert a batch of questions into USGS SensorThings API URLs.
+    LLM calls and ObservedProperties lookups run with bounded concurrency, and shared lookups are only done once.
+    :param queries: the questions to convert
+    :param max_concurrency: the maximum number of concurrent LLM calls and lookups
+    :return: a QueryBatchResult per question in input order, with the error message of failed items
+    """
+    analyses = batch_query_analysis(queries, max_concurrency=max_concurrency)
+    search_params_list = [analysis for analysis in analyses if isinstance(analysis, ThingsSearchModel)]
+    urls = iter(generate_urls(search_params_list, max_concurrency=max_concurrency))
+
+    results = []
+    for query, analysis in zip(queries, analyses):
+        if not isinstance(analysis, ThingsSearchModel):
+            results.append(QueryBatchResult(question=query, error=str(analysis)))
+            continue
+        url = next(urls)
+        if isinstance(url, Exception):
+            results.append(QueryBatchResult(question=query, search_params=analysis, error=str(url)))
+        else:
+            results.append(QueryBatchResult(question=query, search_params=analysis, url=url))
+    return results
 
 def generate_summary_from_json(data: dict) -> str:
     """
@@ -110,10 +389,7 @@ def generate_summary_from_json(data: dict) -> str:
         ]
     )
 
-    llm = ChatOpenAI(
-        api_key=get_openai_key_from_file("openai_key.txt"),
-        model=GPT_MODEL,
-        temperature=0)
+    llm = create_llm()
     output_parser = StrOutputParser()
 
     summary_chain = {"data": RunnablePassthrough()} | prompt | llm | output_parser
@@ -3,12 +3,17 @@
     Speficially, we will be using the following APIs:
     - https://labs.waterdata.usgs.gov/sta/v1.1/
 """
-import requests
 import json
+import hashlib
+import threading
 import pandas as pd
 import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from typing import Any, List, Optional
+from rate_limiter import get_openai_http_client, get_usgs_session
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain.tools import BaseTool, StructuredTool, tool
 from langchain_core.utils.function_calling import convert_to_openai_function
@@ -16,47 +21,230 @@ from langchain_openai import ChatOpenAI
 
 GPT_MODEL = "gpt-3.5-turbo-0613"
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(client, messages, tools=None, tool_choice=None, model=GPT_MODEL):
+# Maximum number of characters and list items a tool output may send to the agent
+TOOL_OUTPUT_MAX_CHARS = 2000
+TOOL_OUTPUT_MAX_ITEMS = 10
+# Maximum number of full tool outputs kept per store for the agent to dereference later
+MAX_STORED_OUTPUTS = 100
+
+class OutputStore:
+    """
+    Thread-safe store of the full tool outputs of an agent run or session, keeping the most recent `max_outputs`.
+    """
+
+    def __init__(self, max_outputs: int = MAX_STORED_OUTPUTS):
+
+        self.max_outputs = max_outputs
+        self.outputs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data: Any) -> str:
+        """
+        Store a full tool output.
+        :param data: the JSON-serializable output
+        :return: the handle of the stored output
+        """
+        handle = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()[:10]
+        with self._lock:
+            self.outputs[handle] = data
+            self.outputs.move_to_end(handle)
+            while len(self.outputs) > self.max_outputs:
+                self.outputs.popitem(last=False)
+        return handle
+
+    def get(self, handle: str) -> Any:
+        """
+        Get a stored tool output.
+        :param handle: the handle of the stored output
+        :return: the output, or None if it is unknown or was evicted
+        """
+        with self._lock:
+            return self.outputs.get(handle)
+
+    def handles(self) -> List[str]:
+        """
+        Get the handles of the stored outputs, oldest first.
+        :return: the handles
+        """
+        with self._lock:
+            return list(self.outputs)
+
+# Store used outside of an output_store_scope, e.g. by the AgentExecutor
+_default_output_store = OutputStore()
+_current_output_store: ContextVar[Optional[OutputStore]] = ContextVar("current_output_store", default=None)
+
+def get_output_store() -> OutputStore:
+    """
+    Get the tool output store of the current agent run, or the process-wide default store outside of a run.
+    :return: the output store
+    """
+    return _current_output_store.get() or _default_output_store
+
+@contextmanager
+def output_store_scope(store: Optional[OutputStore] = None):
+    """
+    Make tools called within the block, including from threads and tasks started in it, use `store`.
+    :param store: the output store, a new one if None
+    :return: the output store
+    """
+    store = store if store is not None else OutputStore()
+    token = _current_output_store.set(store)
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=tools,
-            tool_choice=tool_choice,
-        )
-        return response
-    except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
-        return e
+        yield store
+    finally:
+        _current_output_store.reset(token)
+
+def chat_completion_request(client, messages, tools=None, tool_choice=None, model=GPT_MODEL):
+    """
+    Request a chat completion through the process-wide openai rate limiter, which also handles retries.
+    :param client: the OpenAI client
+    :param messages: the chat messages
+    :param tools: the tools the model may call
+    :param tool_choice: the tool the model must call
+    :param model: the model name
+    :return: the chat completion
+    """
+    client = client.with_options(http_client=get_openai_http_client(), max_retries=0)
+    return client.chat.completions.create(
+        model=model,
+        messages=messages,
+        tools=tools,
+        tool_choice=tool_choice,
+    )
+
+def store_tool_output(data: Any) -> str:
+    """
+    Store a full tool output in the current output store so the agent can dereference it later with `get_stored_output`.
+    :param data: the JSON-serializable output
+    :return: the handle of the stored output
+    """
+    return get_output_store().put(data)
+
+def project_fields(data: Any, fields: List[str]) -> Any:
+    """
+    Keep only the requested fields of a SensorThings entity, or of every entity of a collection.
+    :param data: the JSON data
+    :param fields: the fields to keep, nested fields are separated by "/", e.g. properties/state
+    :return: the projected data
+    """
+    if isinstance(data, dict) and isinstance(data.get("value"), list):
+        return {**data, "value": [project_fields(item, fields) for item in data["value"]]}
+    if not isinstance(data, dict):
+        return data
+
+    projected = {}
+    for field in fields:
+        source, target = data, projected
+        keys = field.split("/")
+        for key in keys[:-1]:
+            if not isinstance(source, dict) or key not in source:
+                break
+            source = source[key]
+            target = target.setdefault(key, {})
+        else:
+            if isinstance(source, dict) and keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+    return projected
+
+def compact_json(data: Any, max_items: int = TOOL_OUTPUT_MAX_ITEMS) -> Any:
+    """
+    Drop SensorThings navigation links and truncate long lists.
+    :param data: the JSON data
+    :param max_items: the maximum number of items kept per list
+    :return: the compacted data
+    """
+    if isinstance(data, dict):
+        return {
+            key: compact_json(value, max_items)
+            for key, value in data.items()
+            if not key.endswith("@iot.navigationLink") and not key.endswith("@iot.selfLink")
+        }
+    if isinstance(data, list):
+        return [compact_json(item, max_items) for item in data[:max_items]]
+    return data
+
+def _has_long_list(data: Any, max_items: int) -> bool:
+    """Check whether the JSON data contains a list longer than `max_items`."""
+    if isinstance(data, dict):
+        return any(_has_long_list(value, max_items) for value in data.values())
+    if isinstance(data, list):
+        return len(data) > max_items or any(_has_long_list(item, max_items) for item in data)
+    return False
+
+def compact_tool_output(data: Any, fields: Optional[List[str]] = None,
+                        max_items: int = TOOL_OUTPUT_MAX_ITEMS, max_chars: int = TOOL_OUTPUT_MAX_CHARS) -> str:
+    """
+    Convert a tool output into a compact string for the agent scratchpad.
+    When anything is truncated, the full output is stored and its handle is appended to the string.
+    :param data: the JSON data
+    :param fields: the fields to keep, keeps all fields if None
+    :param max_items: the maximum number of items kept per list
+    :param max_chars: the maximum number of characters of the string
+    :return: the compact output
+    """
+    projected = project_fields(data, fields) if fields else data
+    text = json.dumps(compact_json(projected, max_items), separators=(",", ":"), default=str)
+    if len(text) <= max_chars and not _has_long_list(projected, max_items):
+        return text
+
+    handle = store_tool_output(data)
+    return text[:max_chars] + f" [truncated, full output stored as handle '{handle}', use get_stored_output to read it]"
 
 @tool
-def query_usgs_sensorthings_api(url: str):
+def query_usgs_sensorthings_api(url: str, fields: Optional[List[str]] = None) -> str:
     """
     Query the USGS SensorThings API. 
     :param url: the URL to query
-    :return: the response from the API
+    :param fields: the fields to keep for each entity, e.g. ["@iot.id", "properties/state"]; keeps all fields if not given
+    :return: a compact JSON response from the API
     """
     print(f"[INFO] Querying USGS SensorThings API at {url}")
-    response = requests.get(url)
-    return response
+    response = get_usgs_session().get(url)
+    return compact_tool_output(response.json(), fields=fields)
 
 @tool
-def get_thing_data(thing_id: str) -> dict:
+def get_thing_data(thing_id: str, fields: Optional[List[str]] = None) -> str:
     """
     Get the data for a specific USGS thing using the `thing_id`.
     :param thing_id: the thing id
-    :return: a pandas dataframe with the data
+    :param fields: the fields to keep, e.g. ["name", "properties/county"]; keeps all fields if not given
+    :return: a compact JSON representation of the thing
     """
     url = f"https://labs.waterdata.usgs.gov/sta/v1.1/Things('{thing_id}')"
     print(f"[INFO] Getting data for thing {thing_id} from {url}")
-    response = requests.get(url)
+    response = get_usgs_session().get(url)
     data = response.json()
     # df = pd.DataFrame(data['value']['timeSeries'][0]['values'][0]['value'])
     # df['dateTime'] = pd.to_datetime(df['dateTime'])
     # df['value'] = pd.to_numeric(df['value'])
-    return data
+    return compact_tool_output(data, fields=fields)
+
+@tool
+def get_stored_output(handle: str, path: str = "", offset: int = 0, limit: int = TOOL_OUTPUT_MAX_ITEMS) -> str:
+    """
+    Read a tool output that was truncated, using the handle given in the truncated output.
+    :param handle: the handle of the stored output
+    :param path: the "/" separated path to read inside the output, e.g. value/3/Datastreams
+    :param offset: the index of the first list item to return, or of the first character for a text output
+    :param limit: the number of list items to return
+    :return: a compact JSON representation of the requested part of the output
+    """
+    data = get_output_store().get(handle)
+    if data is None:
+        return f"Error: no stored output with handle '{handle}'."
+
+    for key in filter(None, path.split("/")):
+        try:
+            data = data[int(key)] if isinstance(data, list) else data[key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            return f"Error: path '{path}' not found in stored output '{handle}'."
+
+    if isinstance(data, str):
+        end = offset + TOOL_OUTPUT_MAX_CHARS
+        return data[offset:end] + (f" [{len(data) - end} more characters, use offset={end}]" if end < len(data) else "")
+    if isinstance(data, list):
+        data = {"total": len(data), "offset": offset, "items": data[offset:offset + limit]}
+    return compact_tool_output(data, max_items=limit)
 
 def get_openai_key_from_file(file: str) -> str:
     """
@@ -0,0 +1,256 @@
+"""
+    This file contains the bulk export of USGS SensorThings query results to Parquet or gzipped CSV files.
+    Results are streamed page by page following @iot.nextLink, so memory stays bounded by a single part file,
+    and a manifest records the progress so an interrupted export can be resumed.
+
+    Example:
+        python export.py "https://labs.waterdata.usgs.gov/sta/v1.1/Things?$filter=..." ./export --format csv
+"""
+import argparse
+import glob
+import json
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+import pandas as pd
+
+from query_analysis import ThingsSearchModel, ThingsSearchUrl
+from rate_limiter import get_usgs_session
+
+MANIFEST_FILE = "_manifest.json"
+EXPORT_FORMATS = {"parquet": "parquet", "csv": "csv.gz"}
+
+# Columns and pandas dtypes of every part file, so the parts of an export can be read as a single dataset.
+# Fields of other columns, or whose value does not fit the dtype, are kept as JSON in the extra column.
+EXPORT_SCHEMA = {
+    "thing.@iot.id": "string",
+    "thing.name": "string",
+    "thing.description": "string",
+    "thing.properties.state": "string",
+    "thing.properties.county": "string",
+    "thing.properties.active": "boolean",
+    "thing.properties.monitoringLocationType": "string",
+    "datastream.@iot.id": "string",
+    "datastream.name": "string",
+    "datastream.description": "string",
+    "observation.@iot.id": "string",
+    "observation.phenomenonTime": "string",
+    "observation.result": "Float64",
+    "extra": "string",
+}
+# Python types accepted for each dtype of EXPORT_SCHEMA
+DTYPE_VALUE_TYPES = {"string": (str, int), "Float64": (int, float), "boolean": (bool,)}
+
+def flatten_entity(entity: Dict[str, Any], prefix: str) -> Dict[str, Any]:
+    """
+    Flatten the fields of a SensorThings entity into columns, skipping navigation links and expanded collections.
+    :param entity: the entity, e.g. a Thing
+    :param prefix: the column prefix, e.g. thing
+    :return: a dict of column names to values, nested fields are separated by "."
+    """
+    row = {}
+    for key, value in entity.items():
+        if "@iot.navigationLink" in key or key.endswith("@iot.nextLink") or key.endswith("@iot.count"):
+            continue
+        if isinstance(value, dict):
+            row.update(flatten_entity(value, f"{prefix}.{key}"))
+        elif isinstance(value, list):
+            # Empty lists cannot be told apart from empty expanded collections
+            if not value or isinstance(value[0], dict):
+                continue
+            row[f"{prefix}.{key}"] = json.dumps(value)
+        else:
+            row[f"{prefix}.{key}"] = value
+    return row
+
+def iter_collection(first_page: Dict[str, Any], key: str) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over an expanded collection of an entity, fetching its next pages when it is truncated.
+    :param first_page: the entity holding the first page of the collection
+    :param key: the collection name, e.g. Observations
+    :return: an iterator over the collection items
+    """
+    yield from first_page.get(key, [])
+    next_link = first_page.get(f"{key}@iot.nextLink")
+    while next_link:
+        response = get_usgs_session().get(next_link)
+        response.raise_for_status()
+        data = response.json()
+        yield from data.get("value", [])
+        next_link = data.get("@iot.nextLink")
+
+def iter_rows(thing: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Flatten a Thing with its expanded Datastreams and Observations into one row per observation.
+    Things without Datastreams and Datastreams without Observations still produce a row.
+    :param thing: the Thing
+    :return: an iterator over the rows
+    """
+    thing_row = flatten_entity(thing, "thing")
+    has_datastreams = False
+    for datastream in iter_collection(thing, "Datastreams"):
+        has_datastreams = True
+        datastream_row = {**thing_row, **flatten_entity(datastream, "datastream")}
+        has_observations = False
+        for observation in iter_collection(datastream, "Observations"):
+            has_observations = True
+            yield {**datastream_row, **flatten_entity(observation, "observation")}
+        if not has_observations:
+            yield datastream_row
+    if not has_datastreams:
+        yield thing_row
+
+def to_record(row: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Fit a flattened row to EXPORT_SCHEMA, moving the fields it does not declare to the extra column.
+    :param row: the row, as returned by iter_rows
+    :return: the record with the EXPORT_SCHEMA columns it has values for
+    """
+    record, extra = {}, {}
+    for column, value in row.items():
+        dtype = EXPORT_SCHEMA.get(column)
+        if value is None or (dtype is not None
+                             and isinstance(value, DTYPE_VALUE_TYPES[dtype])
+                             and isinstance(value, bool) == (dtype == "boolean")):
+            record[column] = value
+        else:
+            extra[column] = value
+    if extra:
+        record["extra"] = json.dumps(extra)
+    return record
+
+def _read_manifest(output_dir: str) -> Optional[Dict[str, Any]]:
+    """Read the export manifest, or None if there is none."""
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def _write_manifest(output_dir: str, manifest: Dict[str, Any]) -> None:
+    """Atomically write the export manifest."""
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def _write_part(rows: List[Dict[str, Any]], path: str, format: str) -> None:
+    """Write rows to a part file with the columns and dtypes of EXPORT_SCHEMA."""
+    df = pd.DataFrame([to_record(row) for row in rows], columns=list(EXPORT_SCHEMA)).astype(EXPORT_SCHEMA)
+    if format == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False, compression="gzip")
+
+def _print_progress(manifest: Dict[str, Any]) -> None:
+    """Default progress callback."""
+    total = f"/{manifest['total_things']}" if manifest.get("total_things") is not None else ""
+    print(f"[INFO] Exported page {manifest['pages']}: {manifest['things']}{total} things, {manifest['rows']} rows")
+
+def export_query_results(search: Union[ThingsSearchModel, str],
+                         output_dir: str,
+                         format: str = "parquet",
+                         max_rows_per_part: int = 100000,
+                         resume: bool = True,
+                         progress_callback: Optional[Callable[[Dict[str, Any]], None]] = _print_progress) -> Dict[str, Any]:
+    """
+    Export every page of a SensorThings Things query to part files in `output_dir`,
+    with one row per Thing, Datastream and Observation and the columns of EXPORT_SCHEMA.
+    Each page of Things is written to one or more part files of at most `max_rows_per_part` rows.
+    The manifest is updated after every page, so a resumed export restarts at the first unfinished page.
+    :param search: the search criteria or the URL of the query;
+        search criteria whose location filter leaves out matching Things raise a ValueError
+    :param output_dir: the directory to write the part files and manifest to, either empty or holding a previous export
+    :param format: the file format, parquet or csv (gzipped)
+    :param max_rows_per_part: the maximum number of rows held in memory and written per part file
+    :param resume: whether to resume a previous export of the same query in `output_dir`
+    :param progress_callback: a function called with the manifest after every page
+    :return: the manifest of the export
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format {format}, use one of {list(EXPORT_FORMATS)}.")
+
+    if isinstance(search, ThingsSearchModel):
+        search_url = ThingsSearchUrl(search)
+        search_url.construct_url()
+        note = search_url.get_location_note()
+        if note is not None:
+            # The location filter left out matching Things, the export would be silently incomplete
+            raise ValueError(f"Cannot export an incomplete search: {note}")
+        url = search_url.url
+    else:
+        url = search
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _read_manifest(output_dir)
+    if manifest is None and os.listdir(output_dir):
+        # Only the part files of a previous export, recorded by its manifest, may be removed
+        raise ValueError(f"Cannot export to {output_dir}: it is not empty and holds no export manifest.")
+    if not resume or manifest is None or manifest["url"] != url or manifest["format"] != format \
+            or manifest.get("schema") != EXPORT_SCHEMA:
+        manifest = {
+            "url": url,
+            "format": format,
+            "next_url": url,
+            "pages": 0,
+            "things": 0,
+            "rows": 0,
+            "total_things": None,
+            "schema": EXPORT_SCHEMA,
+            "complete": False,
+        }
+        for path in glob.glob(os.path.join(output_dir, "part-*")):
+            os.remove(path)
+        # The manifest is written before any part, so an interrupted first page can still be resumed
+        _write_manifest(output_dir, manifest)
+
+    extension = EXPORT_FORMATS[format]
+
+    while manifest["next_url"]:
+        page = manifest["pages"]
+        # Remove the parts of a page interrupted by a previous run
+        for path in glob.glob(os.path.join(output_dir, f"part-{page:05d}-*")):
+            os.remove(path)
+
+        response = get_usgs_session().get(manifest["next_url"])
+        response.raise_for_status()
+        data = response.json()
+        if "@iot.count" in data:
+            manifest["total_things"] = data["@iot.count"]
+
+        rows = []
+        part = 0
+        for thing in data.get("value", []):
+            for row in iter_rows(thing):
+                rows.append(row)
+                if len(rows) >= max_rows_per_part:
+                    _write_part(rows, os.path.join(output_dir, f"part-{page:05d}-{part:03d}.{extension}"), format)
+                    manifest["rows"] += len(rows)
+                    rows = []
+                    part += 1
+        if rows:
+            _write_part(rows, os.path.join(output_dir, f"part-{page:05d}-{part:03d}.{extension}"), format)
+            manifest["rows"] += len(rows)
+
+        manifest["things"] += len(data.get("value", []))
+        manifest["pages"] += 1
+        manifest["next_url"] = data.get("@iot.nextLink")
+        _write_manifest(output_dir, manifest)
+        if progress_callback is not None:
+            progress_callback(manifest)
+
+    manifest["complete"] = True
+    _write_manifest(output_dir, manifest)
+    return manifest
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export USGS SensorThings query results to Parquet or gzipped CSV.")
+    parser.add_argument("url", help="the SensorThings Things query URL, e.g. generated by generate_url")
+    parser.add_argument("output_dir", help="the directory to write the part files to")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="parquet")
+    parser.add_argument("--max-rows-per-part", type=int, default=100000)
+    parser.add_argument("--restart", action="store_true", help="ignore a previous export in output_dir")
+    args = parser.parse_args()
+
+    export_query_results(args.url, args.output_dir, format=args.format,
+                         max_rows_per_part=args.max_rows_per_part, resume=not args.restart)
@@ -15,13 +15,19 @@ def update_embeddings(myTimer: func.TimerRequest) -> None:
     links = utils.find_pages_from_base(url)
     logging.info(f"Found {len(links)} pages to process.")
 
-    # Process the pages
-    embeddings = []
+    # Partition and chunk the pages
+    chunks = []
     for link in links:
-        embeddings.extend(utils.unstructured_page_processing(link))
-        logging.info(f"Processed page: {link} with {len(embeddings)} embeddings.")
+        chunks.extend(utils.chunk_page(link))
+        logging.info(f"Processed page: {link} with {len(chunks)} chunks.")
 
-    logging.info(f"Total chunks processed: {len(embeddings)}.")
+    logging.info(f"Total chunks processed: {len(chunks)}.")
+
+    # Remove boilerplate repeated across pages before embedding
+    chunks = utils.deduplicate_chunks(chunks)
+
+    # Embed the remaining chunks
+    embeddings = utils.embed_chunks(chunks)
 
     # Upsert the embeddings to Pinecone database
     utils.update_embeddings_in_pinecone(embeddings)
@@ -1,11 +1,15 @@
 """ Helper functions for web scraping, Unstructured data processing, embedding calculations, and upserting to Pinecone. """
 
+import hashlib
 import logging
 import os
-from urllib.parse import urlparse
+import random
+import re
+from collections import Counter, deque
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 # Pinecone imports
 from pinecone import Pinecone
@@ -58,92 +62,175 @@ def is_valid_url(url: str) -> str:
     return url
 
 
-# Function to find all pages with the same base URL.
-def find_pages_from_base(base_url: str, max_pages: int = 1000) -> list[str]:
-    """Find all pages with the same base URL. Uses beautiful soup to scan the base page for child pages.
-    This function will recursively scan child pages for more child pages until the max_pages is reached or no new pages are found.
+# Function to canonicalize a URL.
+def canonicalize_url(url: str) -> str:
+    """Canonicalize a URL so the same page is only crawled once. The scheme and host are lowercased,
+    default ports and fragments are dropped, the path ends with a "/" and query parameters are sorted.
 
     Args:
-        base_url (str): The base URL.
-        max_pages (int): A maximum number of hrefs to check. Defaults to 1000.
+        url (str): A URL to canonicalize.
 
     Returns:
-        list: A list of URLs.
+        str: The canonical URL.
+    """
+
+    parsed_url = urlparse(url)
+    scheme = parsed_url.scheme.lower()
+    netloc = (parsed_url.hostname or "").lower()
+    if parsed_url.port and (scheme, parsed_url.port) not in (("http", 80), ("https", 443)):
+        netloc += f":{parsed_url.port}"
+
+    path = parsed_url.path or "/"
+    if not path.endswith("/"):
+        path += "/"
+
+    query = urlencode(sorted(parse_qsl(parsed_url.query, keep_blank_values=True)))
+
+    return urlunparse((scheme, netloc, path, "", query, ""))
+
+
+# Function to extract the hrefs of a webpage.
+def extract_links(content: bytes) -> list[str]:
+    """Extract the hrefs of all anchors in an HTML document. Only <a> tags are built by beautiful soup.
+
+    Args:
+        content (bytes): The HTML content of a webpage.
+
+    Returns:
+        list: A list of hrefs.
     """
 
-    # TODO: This function rigidely processes relatives URLs which may not work for some websites like https://learn.microsoft.com/en-us/azure/azure-functions/.
-    # Can learn from extract_sub_links function defined in langchain/libs/core/langchain_core/utils/html.py
+    soup = BeautifulSoup(content, "html.parser", parse_only=SoupStrainer("a", href=True))
+    return [link["href"] for link in soup.find_all("a")]
+
+
+# Function to crawl all pages with the same base URL and record the link graph.
+def crawl_link_graph(base_url: str, max_pages: int = 1000) -> tuple[list[str], dict]:
+    """Crawl all pages with the same base URL breadth first, starting from the base page.
+    Links are canonicalized and deduplicated before entering the frontier, so every page is queued and fetched once.
+
+    Args:
+        base_url (str): The base URL.
+        max_pages (int): A maximum number of pages to visit. Defaults to 1000.
+
+    Returns:
+        tuple: A list of visited URLs and a dictionary of link graph statistics.
+    """
 
     # Check if the URL is valid
-    base_url = is_valid_url(base_url)
+    base_url = canonicalize_url(is_valid_url(base_url))
 
-    # List to store pages to visit and set to store visited pages
-    visited = set()
-    to_visit = [base_url]
+    # Deque of pages to visit, set of every page ever queued, and list of visited pages
+    to_visit = deque([base_url])
+    seen = {base_url}
+    visited = []
 
-    def scrape(url):
-        # Parse url
-        parsed_url = urlparse(url)
+    in_degree = Counter()
+    stats = {
+        "pages_visited": 0,
+        "pages_failed": 0,
+        "links_found": 0,
+        "links_in_scope": 0,
+        "edges": 0,
+    }
 
-        # Send a GET request to the webpage
-        page = requests.get(url, timeout=10)
-        # Parse the HTML content using BeautifulSoup
-        soup = BeautifulSoup(page.content, "html.parser")
-        links = soup.find_all("a")
+    session = requests.Session()
 
-        for link in links:
-            href = link.get("href")
+    while to_visit:
+        # Check if the number of visited pages reached max pages
+        if len(visited) >= max_pages:
+            logging.warning(f"Max pages reached: {max_pages}.")
+            break
 
-            new_url = None
-            # Check if the href is a child page
-            if href is not None and (href.startswith(parsed_url.path)):
-                new_url = url.replace(parsed_url.path, "") + href
-            elif href is not None and (href.startswith(url)):
-                new_url = href
+        # Get the next page to visit
+        url = to_visit.popleft()
+        logging.debug(f"Visiting URL: {url}")
 
-            # Disregard anchor urls
-            if new_url is not None and "#" in new_url:
-                new_url = None
+        # Send a GET request to the webpage
+        try:
+            page = session.get(url, timeout=10)
+            page.raise_for_status()
+        except requests.RequestException as e:
+            logging.error(f"Error fetching {url}: {e}")
+            stats["pages_failed"] += 1
+            continue
+        visited.append(url)
+
+        # Only parse HTML pages for links
+        if "html" not in page.headers.get("Content-Type", "text/html"):
+            continue
+
+        hrefs = extract_links(page.content)
+        stats["links_found"] += len(hrefs)
+
+        out_links = set()
+        for href in hrefs:
+            # Relative links resolve against the URL actually served, after redirects
+            new_url = canonicalize_url(urljoin(page.url, href))
+
+            # Check if the href is a child page of the base URL
+            if not new_url.startswith(base_url):
+                continue
 
             # Check if new URL is valid
             try:
-                new_url = is_valid_url(new_url)
+                is_valid_url(new_url)
             except ValueError as e:
                 logging.debug(f"Skipping URL Error: {e}")
                 continue
 
-            if new_url is not None and new_url not in visited:
+            stats["links_in_scope"] += 1
+            if new_url == url or new_url in out_links:
+                continue
+            out_links.add(new_url)
+            in_degree[new_url] += 1
+
+            if new_url not in seen:
+                seen.add(new_url)
                 to_visit.append(new_url)
 
-    i = 0
-    while to_visit:
-        # increase counter
-        i += 1
-        logging.debug(f"Visiting URL: {to_visit[0]}")
-        # Check if counter is greater than max pages
-        if i > max_pages:
-            logging.warning(f"Max pages reached: {max_pages}.")
-            break
-        # Get the next page to visit
-        page = to_visit.pop(0)
-        if page not in visited:
-            visited.add(page)
-            scrape(page)
+        stats["edges"] += len(out_links)
 
-    return list(visited)
+    stats["pages_visited"] = len(visited)
+    stats["unique_urls"] = len(seen)
+    stats["frontier_remaining"] = len(to_visit)
+    stats["most_linked"] = in_degree.most_common(10)
 
+    logging.info(
+        f"Crawled {stats['pages_visited']} pages from {base_url} "
+        f"({stats['pages_failed']} failed, {stats['edges']} edges, {stats['unique_urls']} unique URLs)."
+    )
 
-# Function to process unstructured data from a webpage.
-def unstructured_page_processing(
+    return visited, stats
+
+
+# Function to find all pages with the same base URL.
+def find_pages_from_base(base_url: str, max_pages: int = 1000) -> list[str]:
+    """Find all pages with the same base URL. Uses beautiful soup to scan the base page for child pages.
+    This function will recursively scan child pages for more child pages until the max_pages is reached or no new pages are found.
+
+    Args:
+        base_url (str): The base URL.
+        max_pages (int): A maximum number of pages to visit. Defaults to 1000.
+
+    Returns:
+        list: A list of URLs.
+    """
+
+    pages, _ = crawl_link_graph(base_url, max_pages=max_pages)
+
+    return pages
+
+
+# Function to partition and chunk a webpage.
+def chunk_page(
     url: str,
     max_characters: int = 512,
     new_after_n_chars: int = 10,
     overlap: int = 50,
     overlap_all: bool = False,
 ) -> list[Element]:
-    """Process data from a webpage using the Unstructure package.
-    This function will process scraped the webpage by partitioning, chunking, and embedding each chunk.
-    It will return a list of embedded chunks.
+    """Partition a webpage using the Unstructured package and chunk the resulting elements.
 
     Args:
         url (str): A URL to process.
@@ -153,12 +240,9 @@ def unstructured_page_processing(
         overlap_all (bool): A boolean to indicate if all chunks should overlap. Defaults to False.
 
     Returns:
-        list: A list of embedded chunks.
+        list: A list of chunks.
     """
 
-    # Define the OpenAI API key
-    open_ai_api_key = os.getenv("OPENAI_API_KEY")
-
     # Partition webpage into elements
     elements = partition(url=url)
 
@@ -171,22 +255,201 @@ def unstructured_page_processing(
         overlap_all=overlap_all,
     )
 
-    # Embed chunks
+    return chunks
+
+
+# Function to embed chunks using OpenAI.
+def embed_chunks(chunks: list[Element]) -> list[Element]:
+    """Embed chunks using OpenAI's text-embedding-3-small model.
+
+    Args:
+        chunks (list): A list of chunks.
+
+    Returns:
+        list: A list of embedded chunks.
+    """
+
+    # Define the OpenAI API key
+    open_ai_api_key = os.getenv("OPENAI_API_KEY")
+
     embedding_encoder = OpenAIEmbeddingEncoder(
         config=OpenAIEmbeddingConfig(
             api_key=open_ai_api_key, model_name="text-embedding-3-small"
         )
     )
-    embeddings = embedding_encoder.embed_documents(elements=chunks)
+
+    return embedding_encoder.embed_documents(elements=chunks)
+
+
+# Function to process unstructured data from a webpage.
+def unstructured_page_processing(
+    url: str,
+    max_characters: int = 512,
+    new_after_n_chars: int = 10,
+    overlap: int = 50,
+    overlap_all: bool = False,
+) -> list[Element]:
+    """Process data from a webpage using the Unstructure package.
+    This function will process scraped the webpage by partitioning, chunking, and embedding each chunk.
+    It will return a list of embedded chunks.
+
+    Args:
+        url (str): A URL to process.
+        max_characters (int): The maximum number of characters per chunk. Defaults to 512.
+        new_after_n_chars (int): The number of characters to wait before starting a new chunk. Defaults to 10.
+        overlap (int): The maximum number of characters to overlap between chunks. Defaults to 50.
+        overlap_all (bool): A boolean to indicate if all chunks should overlap. Defaults to False.
+
+    Returns:
+        list: A list of embedded chunks.
+    """
+
+    chunks = chunk_page(
+        url,
+        max_characters=max_characters,
+        new_after_n_chars=new_after_n_chars,
+        overlap=overlap,
+        overlap_all=overlap_all,
+    )
+
+    # Embed chunks
+    embeddings = embed_chunks(chunks)
 
     logging.info(f"Successfully computed embeddings for the webpage {url}.")
 
     return embeddings
 
 
+# Mersenne prime used for the MinHash permutations.
+_MINHASH_PRIME = (1 << 61) - 1
+
+
+def _normalize_text(text: str) -> str:
+    """Lowercase a text and collapse its whitespace."""
+    return re.sub(r"\s+", " ", (text or "").lower()).strip()
+
+
+def _shingles(text: str, size: int = 3) -> set[int]:
+    """Hash the word shingles of a normalized text to 64-bit integers."""
+    words = text.split(" ")
+    if len(words) < size:
+        grams = [" ".join(words)]
+    else:
+        grams = [" ".join(words[i : i + size]) for i in range(len(words) - size + 1)]
+    return {
+        int.from_bytes(hashlib.blake2b(g.encode(), digest_size=8).digest(), "big")
+        for g in grams
+    }
+
+
+def _minhash_signature(shingles: set[int], permutations: list[tuple[int, int]]) -> tuple:
+    """Compute the MinHash signature of a set of hashed shingles."""
+    return tuple(
+        min((a * s + b) % _MINHASH_PRIME for s in shingles) for a, b in permutations
+    )
+
+
+# Function to remove exact and near-duplicate chunks across a crawl.
+def deduplicate_chunks(
+    chunks: list[Element],
+    threshold: float = 0.8,
+    num_perm: int = 64,
+    bands: int = 8,
+    seed: int = 1,
+) -> list[Element]:
+    """Remove exact and near-duplicate chunks, such as navigation, header and footer boilerplate repeated across pages.
+    Exact duplicates are detected by hashing the normalized text. Near-duplicates are detected with MinHash signatures
+    bucketed by locality sensitive hashing (LSH), and confirmed when their estimated Jaccard similarity reaches the threshold.
+    The first occurrence of each chunk is kept as the canonical chunk and the URLs of all its duplicates are recorded
+    in its `source_urls` metadata.
+
+    Args:
+        chunks (list): A list of chunks from the whole crawl.
+        threshold (float): The minimum estimated Jaccard similarity for two chunks to be near-duplicates. Defaults to 0.8.
+        num_perm (int): The number of MinHash permutations. Defaults to 64.
+        bands (int): The number of LSH bands, must divide num_perm. Defaults to 8.
+        seed (int): The seed used to draw the MinHash permutations. Defaults to 1.
+
+    Returns:
+        list: A list of canonical chunks.
+    """
+
+    if num_perm % bands != 0:
+        logging.error("The number of permutations must be divisible by the number of bands.")
+        raise ValueError("The number of permutations must be divisible by the number of bands.")
+
+    rows = num_perm // bands
+    rng = random.Random(seed)
+    permutations = [
+        (rng.randrange(1, _MINHASH_PRIME), rng.randrange(0, _MINHASH_PRIME))
+        for _ in range(num_perm)
+    ]
+
+    canonical = []
+    exact_index = {}
+    signatures = []
+    lsh_buckets = [{} for _ in range(bands)]
+    removed_exact = 0
+    removed_near = 0
+    removed_chars = 0
+
+    for chunk in chunks:
+        text = _normalize_text(chunk.text)
+        url = chunk.metadata.url
+
+        # Exact duplicates
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        match = exact_index.get(digest)
+        if match is None:
+            # Near-duplicates
+            signature = _minhash_signature(_shingles(text), permutations)
+            candidates = set()
+            for band in range(bands):
+                key = signature[band * rows : (band + 1) * rows]
+                candidates.update(lsh_buckets[band].get(key, ()))
+            for candidate in sorted(candidates):
+                similarity = sum(
+                    x == y for x, y in zip(signature, signatures[candidate])
+                ) / num_perm
+                if similarity >= threshold:
+                    match = candidate
+                    break
+            if match is None:
+                position = len(canonical)
+                chunk.metadata.source_urls = [url] if url else []
+                canonical.append(chunk)
+                signatures.append(signature)
+                exact_index[digest] = position
+                for band in range(bands):
+                    key = signature[band * rows : (band + 1) * rows]
+                    lsh_buckets[band].setdefault(key, []).append(position)
+                continue
+            removed_near += 1
+        else:
+            removed_exact += 1
+
+        removed_chars += len(chunk.text or "")
+        source_urls = canonical[match].metadata.source_urls
+        if url and url not in source_urls:
+            source_urls.append(url)
+
+    total_chars = sum(len(chunk.text or "") for chunk in chunks)
+    logging.info(
+        f"Removed {removed_exact} exact and {removed_near} near-duplicate chunks out of {len(chunks)} "
+        f"({removed_chars}/{total_chars} characters), keeping {len(canonical)} chunks."
+    )
+
+    return canonical
+
+
+# Maximum number of source URLs stored in the metadata of a vector, Pinecone limits metadata to 40 KB per vector.
+MAX_METADATA_SOURCE_URLS = 20
+
+
 # Function to update embeddings in Pinecone.
 def update_embeddings_in_pinecone(embeddings: list[Element]) -> None:
     """Update embeddings in Pinecone. This function will upsert embeddings to a Pinecone index.
+    The metadata of each vector holds at most MAX_METADATA_SOURCE_URLS source URLs and the total number of them.
 
     Args:
         embeddings (list): A list of embeddings.
@@ -200,12 +463,18 @@ def update_embeddings_in_pinecone(embeddings: list[Element]) -> None:
     # Prepare data for upsert
     data = []
     for element in embeddings:
+        # Boilerplate chunks may come from every crawled page, only the first source URLs are stored
+        source_urls = getattr(element.metadata, "source_urls", None) or [
+            element.metadata.url
+        ]
         data.append(
             {
                 "id": element.id,
                 "values": element.embeddings,
                 "metadata": {
                     "url": element.metadata.url,
+                    "source_urls": source_urls[:MAX_METADATA_SOURCE_URLS],
+                    "source_url_count": len(source_urls),
                     "text": element.text,
                 },
             }
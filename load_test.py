@@ -0,0 +1,117 @@
+"""
+    Load test of the serving mode: simulates many concurrent Streamlit sessions submitting questions
+    to the process-wide worker pool and polling for their results, then reports latency percentiles.
+
+    Example:
+        python load_test.py --sessions 50 --requests 4 --fake-latency 2
+"""
+import argparse
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from serving import QueueFullError, WorkerPool
+
+QUESTIONS = [
+    "Which stream gauges in Wake County, North Carolina measure discharge?",
+    "Are there active wells in Franklin County, Ohio?",
+    "Give me the gage height of streams in Colorado.",
+    "What water temperature data is available in Maricopa County, Arizona?",
+]
+
+def simulate_session(pool: WorkerPool, job: Callable[[str], str], n_requests: int, poll_interval: float,
+                     results: List[Dict[str, float]]) -> None:
+    """
+    Simulate a session submitting questions one after the other and polling the pool until each is answered.
+    :param pool: the worker pool
+    :param job: the function answering a question
+    :param n_requests: the number of questions to submit
+    :param poll_interval: the number of seconds between two polls
+    :param results: the list to append each request's latencies to
+    """
+    for _ in range(n_requests):
+        submitted_at = time.monotonic()
+        try:
+            job_id = pool.submit(job, random.choice(QUESTIONS))
+        except QueueFullError:
+            results.append({"rejected": True})
+            continue
+        while True:
+            state = pool.poll(job_id)
+            if state["status"] not in ("queued", "running"):
+                break
+            time.sleep(poll_interval)
+        results.append({
+            "rejected": False,
+            "failed": state["status"] != "done",
+            "latency": time.monotonic() - submitted_at,
+            "queue_wait": state["started_at"] - state["queued_at"] if state.get("started_at") else 0.0,
+        })
+
+def run_load_test(job: Callable[[str], str], sessions: int, requests: int, workers: int, max_pending: int,
+                  poll_interval: float) -> Dict[str, float]:
+    """
+    Run concurrent simulated sessions against a worker pool.
+    :param job: the function answering a question
+    :param sessions: the number of concurrent sessions
+    :param requests: the number of questions per session
+    :param workers: the number of worker threads
+    :param max_pending: the maximum number of queued and running jobs
+    :param poll_interval: the number of seconds between two polls
+    :return: the latency percentiles and counts
+    """
+    pool = WorkerPool(max_workers=workers, max_pending=max_pending)
+    results: List[Dict[str, float]] = []
+    threads = [threading.Thread(target=simulate_session, args=(pool, job, requests, poll_interval, results))
+               for _ in range(sessions)]
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    answered = [result for result in results if not result["rejected"]]
+    latencies = np.array([result["latency"] for result in answered])
+    queue_waits = np.array([result["queue_wait"] for result in answered])
+    return {
+        "requests": len(results),
+        "rejected": len(results) - len(answered),
+        "failed": sum(result["failed"] for result in answered),
+        "throughput": len(answered) / elapsed,
+        "latency_p50": float(np.percentile(latencies, 50)) if len(latencies) else float("nan"),
+        "latency_p95": float(np.percentile(latencies, 95)) if len(latencies) else float("nan"),
+        "latency_max": float(latencies.max()) if len(latencies) else float("nan"),
+        "queue_wait_p50": float(np.percentile(queue_waits, 50)) if len(queue_waits) else float("nan"),
+        "queue_wait_p95": float(np.percentile(queue_waits, 95)) if len(queue_waits) else float("nan"),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the worker pool with simulated Streamlit sessions.")
+    parser.add_argument("--sessions", type=int, default=20, help="the number of concurrent sessions")
+    parser.add_argument("--requests", type=int, default=3, help="the number of questions per session")
+    parser.add_argument("--workers", type=int, default=8, help="the number of worker threads")
+    parser.add_argument("--max-pending", type=int, default=64, help="the maximum number of queued and running jobs")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="the number of seconds between two polls")
+    parser.add_argument("--fake-latency", type=float, default=None,
+                        help="replace the agent with a job sleeping this many seconds, to test the serving mode offline")
+    args = parser.parse_args()
+
+    if args.fake_latency is not None:
+        def job(question):
+            time.sleep(random.uniform(0.5, 1.5) * args.fake_latency)
+            return question
+    else:
+        from agent import create_agent, run_agent
+        agent, tools = create_agent()
+
+        def job(question):
+            return run_agent(question, agent=agent, tools=tools)["output"]
+
+    report = run_load_test(job, args.sessions, args.requests, args.workers, args.max_pending, args.poll_interval)
+    for key, value in report.items():
+        print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
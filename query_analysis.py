@@ -4,12 +4,19 @@ As a guide, start here: https://python.langchain.com/docs/use_cases/query_analys
 
 from langchain.pydantic_v1 import BaseModel, Field
 from langchain_core.tools import tool
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Union
+from concurrent.futures import ThreadPoolExecutor
 import api_utils
-import requests
+from rate_limiter import get_usgs_session
+from spatial_index import THING_CATALOG_PROPERTIES, ThingIndex, get_thing_index
 
 GPT_MODEL = "gpt-3.5-turbo-0613"
 
+# Maximum number of Thing IDs a location filter may put in the URL
+MAX_LOCATION_IDS = 100
+# Number of Things returned by a location filter without a radius
+DEFAULT_NEAREST_COUNT = 10
+
 class ThingsSearchModel(BaseModel):
     """
     Search over USGS SensorThings Things.
@@ -25,12 +32,39 @@ class ThingsSearchModel(BaseModel):
                                         "It could be 'Well', 'Stream', etc." \
                                         "It always starts with a capital letter.")
     observed_property: Optional[str] = Field(None, description="The observed property required by the filter.")
+    latitude: Optional[float] = Field(None, description="The latitude of the place to search around, in decimal degrees." \
+                                      "For example, 35.78 for Raleigh, North Carolina.")
+    longitude: Optional[float] = Field(None, description="The longitude of the place to search around, in decimal degrees." \
+                                       "For example, -78.64 for Raleigh, North Carolina.")
+    radius_miles: Optional[float] = Field(None, description="The distance in miles around the latitude and longitude to search within.")
+    nearest_count: Optional[int] = Field(None, description="The number of things nearest to the latitude and longitude to return.")
+
+def fetch_observed_property_ids(observed_property: str) -> Dict[str, str]:
+    """
+    Look up the USGS SensorThings ObservedProperties whose name contains `observed_property`.
+    :param observed_property: the observed property to look up
+    :return: a dict of acceptable observed property IDs with their names as values
+    """
+    url = "https://labs.waterdata.usgs.gov/sta/v1.1/ObservedProperties" \
+            f"?$filter=substringof('{observed_property}',name)" \
+            "&$select=@iot.id,name"
+
+    id_dict = {}
+    response = get_usgs_session().get(url)
+    data = response.json()
+    for item in data["value"]:
+        id_dict[item["@iot.id"]] = item["name"]
+    return id_dict
 
 class ThingsSearchUrl:
 
-    def __init__(self, search_params: ThingsSearchModel):
+    def __init__(self, search_params: ThingsSearchModel, observed_property_ids: Optional[Dict[str, str]] = None,
+                 spatial_index: Optional[ThingIndex] = None):
 
         self.search_params = search_params
+        self.observed_property_ids = observed_property_ids
+        self.spatial_index = spatial_index
+        self.location_match_count: Optional[int] = None
         self.url: str = "https://labs.waterdata.usgs.gov/sta/v1.1/Things"
 
     def construct_url(self) -> None:
@@ -78,6 +112,9 @@ class ThingsSearchUrl:
             filters.append(f"properties/active eq {self.search_params.active}")
         if self.search_params.monitoring_location_type:
             filters.append(f"properties/monitoringLocationType eq '{self.search_params.monitoring_location_type}'")
+        location_filter = self.get_location_filter_str()
+        if location_filter:
+            filters.append(location_filter)
         
         if filters:
             filter_str += "(" + " and ".join(filters) + ")"
@@ -85,22 +122,67 @@ class ThingsSearchUrl:
         return filter_str if filter_str else None
     
 
+    def get_location_ids(self) -> List[str]:
+        """
+        Get the IDs of the Things around the searched location from the local spatial index.
+        Things within `radius_miles` are returned nearest first, limited to `nearest_count`.
+        The state, county, active and monitoring location type criteria are applied locally first,
+        so only the Things matching them count towards MAX_LOCATION_IDS.
+        The number of matching Things before that limit is kept in `location_match_count`.
+        :return: a list of at most MAX_LOCATION_IDS Thing IDs, or None if the search has no location
+        """
+        if self.search_params.latitude is None or self.search_params.longitude is None:
+            return None
+
+        index = self.spatial_index or get_thing_index()
+        where = {name: getattr(self.search_params, name)
+                 for name in THING_CATALOG_PROPERTIES if getattr(self.search_params, name)}
+        if self.search_params.radius_miles:
+            matches = index.query_radius(self.search_params.latitude, self.search_params.longitude,
+                                         self.search_params.radius_miles, where)
+            if self.search_params.nearest_count:
+                matches = matches[:self.search_params.nearest_count]
+        else:
+            matches = index.nearest(self.search_params.latitude, self.search_params.longitude,
+                                    self.search_params.nearest_count or DEFAULT_NEAREST_COUNT, where)
+        self.location_match_count = len(matches)
+        return [id for id, _ in matches[:MAX_LOCATION_IDS]]
+
+    def get_location_filter_str(self) -> str:
+        """
+        Return a Thing ID-based filter matching the Things around the searched location.
+        :return: the filter string
+        """
+        ids = self.get_location_ids()
+        if ids is None:
+            return None
+        if not ids:
+            # No Thing around the location, the filter must not match anything
+            return "@iot.id eq ''"
+
+        return "(" + " or ".join(f"@iot.id eq '{id}'" for id in ids) + ")"
+
+    def get_location_note(self) -> str:
+        """
+        Return a note telling the caller that the location filter left out some of the matching Things.
+        Must be called after the URL is constructed.
+        :return: the note, or None if no matching Thing was left out
+        """
+        if self.location_match_count is None or self.location_match_count <= MAX_LOCATION_IDS:
+            return None
+        return f"[Note: the location filter only includes the {MAX_LOCATION_IDS} nearest of the " \
+               f"{self.location_match_count} matching things, reduce radius_miles or nearest_count for complete results]"
+
     def get_observed_property_id(self) -> Dict[str, str]:
         """
         Get the observed property IDs based on the search parameters.
+        The IDs are only looked up once, or not at all if they were passed to the constructor.
         :return: a dict of acceptable observed property IDs with their names as values
         """
         if self.search_params.observed_property:
-            url = "https://labs.waterdata.usgs.gov/sta/v1.1/ObservedProperties" \
-                    f"?$filter=substringof('{self.search_params.observed_property}',name)" \
-                    "&$select=@iot.id,name"
-            
-            id_dict = {}
-            response = requests.get(url)
-            data = response.json()
-            for item in data["value"]:
-                id_dict[item["@iot.id"]] = item["name"]
-            return id_dict
+            if self.observed_property_ids is None:
+                self.observed_property_ids = fetch_observed_property_ids(self.search_params.observed_property)
+            return self.observed_property_ids
         return None
     
     def get_observed_property_filter_str(self) -> str:
@@ -132,7 +214,8 @@ class ThingsSearchUrl:
 
 
 @tool("generate_url", args_schema=ThingsSearchModel)
-def generate_url(state, county, active, monitoring_location_type, observed_property) -> str:
+def generate_url(state, county, active, monitoring_location_type, observed_property,
+                 latitude=None, longitude=None, radius_miles=None, nearest_count=None) -> str:
     """
     Generate URL to retrieve USGS SensorThings Things based on the search criteria.
     :param state: the state to search in
@@ -140,15 +223,63 @@ def generate_url(state, county, active, monitoring_location_type, observed_prope
     :param active: whether the thing is active
     :param monitoring_location_type: the type of the thing
     :param observed_property: the observed property required by the filter
-    :return: the URL to retrieve the data
+    :param latitude: the latitude of the place to search around
+    :param longitude: the longitude of the place to search around
+    :param radius_miles: the distance in miles around the place to search within
+    :param nearest_count: the number of things nearest to the place to return
+    :return: the URL to retrieve the data, followed by a note when the location filter left out matching things
     """
     search_params = ThingsSearchModel(
         state=state,
         county=county,
         active=active,
         monitoring_location_type=monitoring_location_type,
-        observed_property=observed_property
+        observed_property=observed_property,
+        latitude=latitude,
+        longitude=longitude,
+        radius_miles=radius_miles,
+        nearest_count=nearest_count
     )
     search_url = ThingsSearchUrl(search_params)
     search_url.construct_url()
-    return search_url.url
\ No newline at end of file
+    note = search_url.get_location_note()
+    return search_url.url + "\n" + note if note else search_url.url
+
+def generate_urls(search_params_list: List[ThingsSearchModel], max_concurrency: int = 8) -> List[Union[str, Exception]]:
+    """
+    Generate URLs for a batch of search criteria.
+    Each distinct observed property is looked up once, with at most `max_concurrency` lookups running at the same time.
+    :param search_params_list: the search criteria
+    :param max_concurrency: the maximum number of concurrent ObservedProperties lookups
+    :return: the URLs in input order, followed by a note when their location filter left out matching things,
+        or the exception raised while generating each of them
+    """
+    observed_properties = {
+        search_params.observed_property
+        for search_params in search_params_list
+        if search_params.observed_property
+    }
+
+    def lookup(observed_property):
+        try:
+            return fetch_observed_property_ids(observed_property)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        lookups = dict(zip(observed_properties, executor.map(lookup, observed_properties)))
+
+    urls = []
+    for search_params in search_params_list:
+        observed_property_ids = lookups.get(search_params.observed_property)
+        if isinstance(observed_property_ids, Exception):
+            urls.append(observed_property_ids)
+            continue
+        try:
+            search_url = ThingsSearchUrl(search_params, observed_property_ids=observed_property_ids)
+            search_url.construct_url()
+            note = search_url.get_location_note()
+            urls.append(search_url.url + "\n" + note if note else search_url.url)
+        except Exception as e:
+            urls.append(e)
+    return urls
\ No newline at end of file
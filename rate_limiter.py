@@ -0,0 +1,454 @@
+"""
+    This file contains the process-wide rate limiters shared by every call to an upstream API:
+    - openai: chat completions made by the langchain chains, the agent and chat_completion_request
+    - usgs: the USGS SensorThings API https://labs.waterdata.usgs.gov/sta/v1.1/
+
+    Each limiter combines token buckets on requests and tokens per minute, an AIMD concurrency limit
+    adjusted from 429 responses and their Retry-After header, and a circuit breaker.
+"""
+import asyncio
+import random
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Dict, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Status codes that are retried and count as failures for the circuit breaker
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Connect and read timeouts in seconds of requests sent through a RateLimitedAdapter without a timeout of their own
+DEFAULT_TIMEOUT = (10, 60)
+
+LIMITER_CONFIGS = {
+    "openai": {
+        "requests_per_minute": 3500,
+        "tokens_per_minute": 90000,
+        "max_concurrency": 16,
+    },
+    "usgs": {
+        "requests_per_minute": 600,
+        "tokens_per_minute": None,
+        "max_concurrency": 8,
+    },
+}
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a call is attempted while the circuit breaker of its upstream is open.
+    """
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate` tokens per second, holding at most `capacity` tokens.
+    Reservations may overdraw the bucket, the caller then waits until the balance is paid back.
+    A reservation larger than the capacity is charged in full, so large calls still pay their whole cost in waiting time.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` tokens from the bucket. Not thread-safe, the RateLimiter holds its lock.
+        :param amount: the number of tokens to take
+        :return: the number of seconds to wait before using the tokens
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+class RateLimiter:
+    """
+    Rate limiter of a single upstream API.
+    """
+
+    def __init__(self,
+                 name: str,
+                 requests_per_minute: float,
+                 tokens_per_minute: Optional[float] = None,
+                 max_concurrency: int = 8,
+                 min_concurrency: int = 1,
+                 failure_threshold: int = 5,
+                 reset_timeout: float = 30.0,
+                 max_attempts: int = 3,
+                 backoff_base: float = 1.0,
+                 backoff_max: float = 40.0):
+
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute / 60, requests_per_minute / 60)
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_trial = False
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.counters = {
+            "requests": 0,
+            "successes": 0,
+            "throttled": 0,
+            "failures": 0,
+            "retries": 0,
+            "rejected": 0,
+            "circuit_opens": 0,
+            "wait_seconds": 0.0,
+        }
+        self._lock = threading.Lock()
+        self._slot_released = threading.Condition(self._lock)
+
+    def _check_circuit(self) -> None:
+        """Raise CircuitOpenError if the circuit is open, letting a single trial call through once it is half-open."""
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_timeout or self.half_open_trial:
+            self.counters["rejected"] += 1
+            raise CircuitOpenError(f"Circuit breaker for {self.name} is open.")
+        self.half_open_trial = True
+
+    def _try_acquire(self, tokens: float) -> Optional[float]:
+        """
+        Try to take a concurrency slot. Must be called with the lock held.
+        :param tokens: the estimated number of tokens of the call
+        :return: the number of seconds to wait before sending the call, or None if no slot is free
+        """
+        self._check_circuit()
+        if self.in_flight >= max(self.min_concurrency, int(self.concurrency_limit)):
+            return None
+        self.in_flight += 1
+        self.counters["requests"] += 1
+        delay = self.request_bucket.reserve(1)
+        if self.token_bucket is not None:
+            delay = max(delay, self.token_bucket.reserve(tokens))
+        delay = max(delay, self.blocked_until - time.monotonic())
+        self.counters["wait_seconds"] += delay
+        return delay
+
+    def acquire(self, tokens: float = 1) -> None:
+        """
+        Block until a call may be sent upstream. Every acquire must be followed by a release or a cancel,
+        prefer the `slot` context manager which guarantees it.
+        :param tokens: the estimated number of tokens of the call
+        """
+        with self._slot_released:
+            delay = self._try_acquire(tokens)
+            while delay is None:
+                self._slot_released.wait()
+                delay = self._try_acquire(tokens)
+        if delay > 0:
+            try:
+                time.sleep(delay)
+            except BaseException:
+                self.cancel()
+                raise
+
+    async def aacquire(self, tokens: float = 1) -> None:
+        """
+        Asynchronous version of acquire, polling for a free concurrency slot without blocking the event loop.
+        The slot is given back if the call is cancelled while waiting.
+        :param tokens: the estimated number of tokens of the call
+        """
+        while True:
+            with self._lock:
+                delay = self._try_acquire(tokens)
+            if delay is not None:
+                break
+            await asyncio.sleep(0.05)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.cancel()
+                raise
+
+    @contextmanager
+    def slot(self, tokens: float = 1):
+        """
+        Hold a concurrency slot for the duration of a call. The yielded dict takes the `status_code` and
+        `retry_after` of the response. The slot is always freed: a call raising an Exception is recorded as a failure,
+        a cancelled or interrupted call is not recorded.
+        :param tokens: the estimated number of tokens of the call
+        """
+        self.acquire(tokens)
+        outcome = {"status_code": None, "retry_after": None}
+        try:
+            yield outcome
+        except Exception:
+            self.release()
+            raise
+        except BaseException:
+            self.cancel()
+            raise
+        self.release(outcome["status_code"], outcome["retry_after"])
+
+    @asynccontextmanager
+    async def aslot(self, tokens: float = 1):
+        """
+        Asynchronous version of slot.
+        :param tokens: the estimated number of tokens of the call
+        """
+        await self.aacquire(tokens)
+        outcome = {"status_code": None, "retry_after": None}
+        try:
+            yield outcome
+        except Exception:
+            self.release()
+            raise
+        except BaseException:
+            self.cancel()
+            raise
+        self.release(outcome["status_code"], outcome["retry_after"])
+
+    def cancel(self) -> None:
+        """
+        Free the concurrency slot of a call that was cancelled before it completed, without recording an outcome.
+        A cancelled half-open trial lets the next call become the trial.
+        """
+        with self._slot_released:
+            self.in_flight -= 1
+            self.half_open_trial = False
+            self._slot_released.notify_all()
+
+    def release(self, status_code: Optional[int] = None, retry_after: Optional[float] = None) -> None:
+        """
+        Record the outcome of a call and free its concurrency slot.
+        The concurrency limit grows by one per window of successful calls and halves on a 429.
+        :param status_code: the HTTP status code of the response, None if the call raised
+        :param retry_after: the number of seconds requested by the Retry-After header
+        """
+        with self._slot_released:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status_code is not None and status_code not in RETRY_STATUS_CODES:
+                self.counters["successes"] += 1
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+                self.consecutive_failures = 0
+                self.opened_at = None
+                self.half_open_trial = False
+            else:
+                self.counters["failures"] += 1
+                if status_code == 429:
+                    self.counters["throttled"] += 1
+                    self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                    if retry_after:
+                        self.blocked_until = max(self.blocked_until, now + retry_after)
+                self.consecutive_failures += 1
+                if self.half_open_trial or self.consecutive_failures >= self.failure_threshold:
+                    if self.opened_at is None or self.half_open_trial:
+                        self.counters["circuit_opens"] += 1
+                    self.opened_at = now
+                    self.half_open_trial = False
+            self._slot_released.notify_all()
+
+    def retry_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Compute the delay before retrying a call, using full jitter so throttled callers do not retry together.
+        :param attempt: the number of attempts made so far
+        :param retry_after: the number of seconds requested by the Retry-After header
+        :return: the number of seconds to wait
+        """
+        with self._lock:
+            self.counters["retries"] += 1
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(backoff, retry_after or 0.0)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get a snapshot of the limiter counters and state.
+        :return: the counters, the current concurrency limit, the calls in flight and the circuit state
+        """
+        with self._lock:
+            if self.opened_at is None:
+                circuit = "closed"
+            elif time.monotonic() - self.opened_at < self.reset_timeout:
+                circuit = "open"
+            else:
+                circuit = "half-open"
+            return {
+                **self.counters,
+                "concurrency_limit": self.concurrency_limit,
+                "in_flight": self.in_flight,
+                "circuit": circuit,
+            }
+
+@lru_cache(maxsize=None)
+def get_limiter(name: str) -> RateLimiter:
+    """
+    Get the process-wide rate limiter of an upstream API configured in LIMITER_CONFIGS.
+    :param name: the upstream name, e.g. openai or usgs
+    :return: the rate limiter
+    """
+    return RateLimiter(name, **LIMITER_CONFIGS[name])
+
+def get_retry_after(headers) -> Optional[float]:
+    """
+    Parse the Retry-After header (in seconds) of a response.
+    :param headers: the response headers
+    :return: the number of seconds, or None if the header is missing or not a number
+    """
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(content: bytes) -> float:
+    """
+    Estimate the number of tokens of a request body, assuming 4 bytes per token.
+    :param content: the request body
+    :return: the estimated number of tokens
+    """
+    return max(1, len(content or b"") / 4)
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    httpx transport sending every request through a rate limiter and retrying throttled and failed requests.
+    """
+
+    def __init__(self, limiter: RateLimiter, transport: Optional[httpx.BaseTransport] = None):
+
+        self.limiter = limiter
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        tokens = estimate_tokens(request.read())
+        for attempt in range(self.limiter.max_attempts):
+            last_attempt = attempt + 1 == self.limiter.max_attempts
+            try:
+                with self.limiter.slot(tokens) as outcome:
+                    response = self.transport.handle_request(request)
+                    outcome.update(status_code=response.status_code, retry_after=get_retry_after(response.headers))
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+                time.sleep(self.limiter.retry_delay(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                return response
+            response.close()
+            time.sleep(self.limiter.retry_delay(attempt, outcome["retry_after"]))
+
+    def close(self) -> None:
+        self.transport.close()
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Asynchronous version of RateLimitedTransport.
+    Connections are bound to their event loop, so unless a transport is given, one connection pool is kept per event loop
+    and the transport can be shared by clients running on different threads and loops.
+    """
+
+    def __init__(self, limiter: RateLimiter, transport: Optional[httpx.AsyncBaseTransport] = None):
+
+        self.limiter = limiter
+        self.transport = transport
+        self._loop_transports = weakref.WeakKeyDictionary()
+
+    def _get_transport(self) -> httpx.AsyncBaseTransport:
+        """Get the given transport, or the connection pool of the running event loop."""
+        if self.transport is not None:
+            return self.transport
+        loop = asyncio.get_running_loop()
+        if loop not in self._loop_transports:
+            self._loop_transports[loop] = httpx.AsyncHTTPTransport()
+        return self._loop_transports[loop]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        tokens = estimate_tokens(await request.aread())
+        for attempt in range(self.limiter.max_attempts):
+            last_attempt = attempt + 1 == self.limiter.max_attempts
+            try:
+                async with self.limiter.aslot(tokens) as outcome:
+                    response = await self._get_transport().handle_async_request(request)
+                    outcome.update(status_code=response.status_code, retry_after=get_retry_after(response.headers))
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+                await asyncio.sleep(self.limiter.retry_delay(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                return response
+            await response.aclose()
+            await asyncio.sleep(self.limiter.retry_delay(attempt, outcome["retry_after"]))
+
+    async def aclose(self) -> None:
+        await self._get_transport().aclose()
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    requests adapter sending every request through a rate limiter and retrying throttled and failed requests.
+    """
+
+    def __init__(self, limiter: RateLimiter, timeout=DEFAULT_TIMEOUT, **kwargs):
+
+        self.limiter = limiter
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        for attempt in range(self.limiter.max_attempts):
+            last_attempt = attempt + 1 == self.limiter.max_attempts
+            try:
+                with self.limiter.slot() as outcome:
+                    response = super().send(request, **kwargs)
+                    outcome.update(status_code=response.status_code, retry_after=get_retry_after(response.headers))
+            except requests.RequestException:
+                if last_attempt:
+                    raise
+                time.sleep(self.limiter.retry_delay(attempt))
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                return response
+            response.close()
+            time.sleep(self.limiter.retry_delay(attempt, outcome["retry_after"]))
+
+@lru_cache(maxsize=None)
+def get_openai_http_client() -> httpx.Client:
+    """
+    Get the process-wide httpx client to pass to OpenAI clients, routed through the openai rate limiter.
+    OpenAI clients using it should set max_retries=0 since retries are handled by the limiter.
+    :return: the httpx client
+    """
+    return httpx.Client(transport=RateLimitedTransport(get_limiter("openai")),
+                        timeout=httpx.Timeout(600.0, connect=5.0))
+
+@lru_cache(maxsize=None)
+def get_openai_async_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide asynchronous httpx client to pass to OpenAI clients, routed through the openai rate limiter.
+    It keeps one connection pool per event loop, see AsyncRateLimitedTransport.
+    :return: the httpx client
+    """
+    return httpx.AsyncClient(transport=AsyncRateLimitedTransport(get_limiter("openai")),
+                             timeout=httpx.Timeout(600.0, connect=5.0))
+
+@lru_cache(maxsize=None)
+def get_usgs_session() -> requests.Session:
+    """
+    Get the process-wide requests session for the USGS SensorThings API, routed through the usgs rate limiter.
+    :return: the requests session
+    """
+    session = requests.Session()
+    session.mount("https://labs.waterdata.usgs.gov/", RateLimitedAdapter(get_limiter("usgs")))
+    return session
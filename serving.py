@@ -0,0 +1,110 @@
+"""
+    This file contains the process-wide worker pool running long chatbot requests (e.g. agent runs)
+    off the Streamlit script threads. Sessions submit a job, keep its ID and poll for its result on later reruns.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict
+
+# Number of jobs running at the same time
+MAX_WORKERS = 8
+# Number of jobs waiting or running before new submissions are rejected
+MAX_PENDING_JOBS = 64
+# Number of seconds a finished job is kept for its session to poll it
+RESULT_TTL = 600
+
+class QueueFullError(Exception):
+    """
+    Raised when a job is submitted while the worker pool queue is full.
+    """
+
+class WorkerPool:
+    """
+    Bounded pool of worker threads with a bounded request queue.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_pending: int = MAX_PENDING_JOBS, result_ttl: float = RESULT_TTL):
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="usgs-chat-worker")
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    def _run(self, job_id: str, fn: Callable, args: tuple, kwargs: dict) -> None:
+        """Run a job and record its result or error."""
+        with self._lock:
+            self.jobs[job_id].update(status="running", started_at=time.monotonic())
+        try:
+            outcome = {"status": "done", "result": fn(*args, **kwargs)}
+        except Exception as e:
+            outcome = {"status": "failed", "error": str(e)}
+        with self._lock:
+            self.jobs[job_id].update(outcome, finished_at=time.monotonic())
+            self.counters["completed" if outcome["status"] == "done" else "failed"] += 1
+
+    def _expire(self) -> None:
+        """Forget finished jobs which were not polled within result_ttl. Must be called with the lock held."""
+        now = time.monotonic()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job["finished_at"] is not None and now - job["finished_at"] > self.result_ttl]:
+            del self.jobs[job_id]
+            self.counters["expired"] += 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> str:
+        """
+        Queue a job on the worker pool.
+        :param fn: the function to run
+        :return: the job ID to poll
+        """
+        with self._lock:
+            self._expire()
+            if sum(job["finished_at"] is None for job in self.jobs.values()) >= self.max_pending:
+                self.counters["rejected"] += 1
+                raise QueueFullError("Too many requests are being processed, please try again shortly.")
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {
+                "status": "queued",
+                "result": None,
+                "error": None,
+                "queued_at": time.monotonic(),
+                "started_at": None,
+                "finished_at": None,
+            }
+            self.counters["submitted"] += 1
+        self.executor.submit(self._run, job_id, fn, args, kwargs)
+        return job_id
+
+    def poll(self, job_id: str) -> Dict[str, Any]:
+        """
+        Get the state of a job. Finished jobs are forgotten once polled.
+        :param job_id: the job ID returned by submit
+        :return: the job status (queued, running, done, failed or unknown), result, error and timestamps
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return {"status": "unknown", "result": None, "error": "Unknown or expired job."}
+            if job["finished_at"] is not None:
+                del self.jobs[job_id]
+            return dict(job)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get a snapshot of the pool counters.
+        :return: the counters and the number of pending jobs
+        """
+        with self._lock:
+            return {**self.counters, "pending": sum(job["finished_at"] is None for job in self.jobs.values())}
+
+@lru_cache(maxsize=None)
+def get_worker_pool() -> WorkerPool:
+    """
+    Get the process-wide worker pool shared by every Streamlit session.
+    :return: the worker pool
+    """
+    return WorkerPool()
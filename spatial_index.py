@@ -0,0 +1,282 @@
+"""
+    This file contains a local spatial index over the locations of USGS SensorThings Things,
+    used to answer proximity questions such as "gauges within 20 miles of Raleigh".
+    The catalog of Thing locations is cached to a local Parquet file, refreshed by a scheduled `python spatial_index.py` job
+    or in the background once it is older than its max age.
+"""
+import argparse
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from rate_limiter import get_usgs_session
+
+THING_CATALOG_PATH = "thing_catalog.parquet"
+THING_CATALOG_MAX_AGE = 7 * 24 * 3600
+# Number of seconds before a failed background refresh of the catalog is retried
+THING_INDEX_RETRY_INTERVAL = 300
+THING_CATALOG_URL = "https://labs.waterdata.usgs.gov/sta/v1.1/Things" \
+                    "?$select=@iot.id,properties/state,properties/county,properties/active,properties/monitoringLocationType" \
+                    "&$expand=Locations($select=location)" \
+                    "&$top=10000"
+
+# Thing properties kept in the catalog, by catalog column, so searches can be filtered locally
+THING_CATALOG_PROPERTIES = {
+    "state": "state",
+    "county": "county",
+    "active": "active",
+    "monitoring_location_type": "monitoringLocationType",
+}
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE = 69.0
+
+class ThingCatalogUnavailableError(Exception):
+    """
+    Raised when the spatial index is requested before any catalog of Thing locations was cached.
+    """
+
+def haversine_miles(lat: float, lon: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """
+    Compute the great circle distances between a point and arrays of points.
+    :param lat: the latitude of the point
+    :param lon: the longitude of the point
+    :param latitudes: the latitudes of the points
+    :param longitudes: the longitudes of the points
+    :return: the distances in miles
+    """
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+class ThingIndex:
+    """
+    Grid index over Thing locations, bucketing Things into cells of `cell_size` degrees.
+    Queries only compute distances for the Things of the cells overlapping the search area,
+    optionally keeping only the Things whose properties match.
+    """
+
+    def __init__(self, ids: List[str], latitudes: List[float], longitudes: List[float], cell_size: float = 0.25,
+                 properties: Optional[Dict[str, List[Any]]] = None):
+
+        self.ids = np.asarray(ids, dtype=object)
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.properties = {name: np.asarray(values, dtype=object) for name, values in (properties or {}).items()}
+        self.cell_size = cell_size
+
+        rows = np.floor(self.latitudes / cell_size).astype(int)
+        cols = np.floor(self.longitudes / cell_size).astype(int)
+        order = np.lexsort((cols, rows))
+        self.cells: Dict[Tuple[int, int], np.ndarray] = {}
+        if len(order):
+            keys = np.stack([rows[order], cols[order]], axis=1)
+            starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+            for group in np.split(order, starts):
+                self.cells[(int(rows[group[0]]), int(cols[group[0]]))] = group
+
+    @classmethod
+    def from_catalog(cls, catalog: pd.DataFrame) -> "ThingIndex":
+        """
+        Build an index from a catalog of Thing locations, keeping the Thing properties it has.
+        :param catalog: a dataframe with the id, latitude and longitude of each Thing, and optionally their properties
+        :return: the spatial index
+        """
+        properties = {name: catalog[name] for name in THING_CATALOG_PROPERTIES if name in catalog.columns}
+        return cls(catalog["id"], catalog["latitude"], catalog["longitude"], properties=properties)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _matching(self, candidates: np.ndarray, where: Optional[Dict[str, Any]]) -> np.ndarray:
+        """Keep the candidates whose properties equal the `where` values. Properties missing from the index are ignored."""
+        for name, value in (where or {}).items():
+            if name in self.properties:
+                candidates = candidates[self.properties[name][candidates] == value]
+        return candidates
+
+    def _candidates(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> np.ndarray:
+        """Get the indices of the Things in the cells overlapping a bounding box."""
+        min_row, max_row = math.floor(min_lat / self.cell_size), math.floor(max_lat / self.cell_size)
+        min_col, max_col = math.floor(min_lon / self.cell_size), math.floor(max_lon / self.cell_size)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            groups = [group for (row, col), group in self.cells.items()
+                      if min_row <= row <= max_row and min_col <= col <= max_col]
+        else:
+            groups = [self.cells[(row, col)]
+                      for row in range(min_row, max_row + 1)
+                      for col in range(min_col, max_col + 1)
+                      if (row, col) in self.cells]
+        return np.concatenate(groups) if groups else np.empty(0, dtype=int)
+
+    def query_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> List[str]:
+        """
+        Find the Things inside a bounding box.
+        :param min_lat: the southern latitude
+        :param min_lon: the western longitude
+        :param max_lat: the northern latitude
+        :param max_lon: the eastern longitude
+        :return: the Thing IDs
+        """
+        candidates = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        lats, lons = self.latitudes[candidates], self.longitudes[candidates]
+        inside = (lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)
+        return list(self.ids[candidates[inside]])
+
+    def query_radius(self, lat: float, lon: float, radius_miles: float,
+                     where: Optional[Dict[str, Any]] = None) -> List[Tuple[str, float]]:
+        """
+        Find the Things within a distance of a point.
+        :param lat: the latitude of the point
+        :param lon: the longitude of the point
+        :param radius_miles: the search radius in miles
+        :param where: the property values the Things must have, e.g. {"state": "North Carolina"}
+        :return: the Thing IDs and their distances in miles, nearest first
+        """
+        dlat = radius_miles / MILES_PER_DEGREE
+        dlon = radius_miles / (MILES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+        candidates = self._matching(self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon), where)
+        distances = haversine_miles(lat, lon, self.latitudes[candidates], self.longitudes[candidates])
+        inside = distances <= radius_miles
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+        return [(self.ids[i], float(d)) for i, d in zip(candidates[order], distances[order])]
+
+    def nearest(self, lat: float, lon: float, k: int = 10,
+                where: Optional[Dict[str, Any]] = None) -> List[Tuple[str, float]]:
+        """
+        Find the k Things nearest to a point, doubling the search radius until enough Things are found.
+        :param lat: the latitude of the point
+        :param lon: the longitude of the point
+        :param k: the number of Things
+        :param where: the property values the Things must have, e.g. {"state": "North Carolina"}
+        :return: the Thing IDs and their distances in miles, nearest first
+        """
+        radius = 10.0
+        while True:
+            matches = self.query_radius(lat, lon, radius, where)
+            if len(matches) >= k or radius >= math.pi * EARTH_RADIUS_MILES:
+                return matches[:k]
+            radius *= 2
+
+def fetch_thing_catalog(url: str = THING_CATALOG_URL) -> pd.DataFrame:
+    """
+    Fetch the location and properties of every Thing from the USGS SensorThings API, following @iot.nextLink.
+    :param url: the URL of the first page
+    :return: a dataframe with the id, latitude, longitude and THING_CATALOG_PROPERTIES of each Thing
+    """
+    ids, latitudes, longitudes = [], [], []
+    properties = {name: [] for name in THING_CATALOG_PROPERTIES}
+    while url:
+        print(f"[INFO] Fetching Thing locations from {url}")
+        response = get_usgs_session().get(url)
+        response.raise_for_status()
+        data = response.json()
+        for thing in data.get("value", []):
+            for location in thing.get("Locations", []):
+                geometry = location.get("location") or {}
+                if geometry.get("type") == "Point":
+                    longitude, latitude = geometry["coordinates"][:2]
+                    ids.append(thing["@iot.id"])
+                    latitudes.append(latitude)
+                    longitudes.append(longitude)
+                    for name, key in THING_CATALOG_PROPERTIES.items():
+                        properties[name].append((thing.get("properties") or {}).get(key))
+                    break
+        url = data.get("@iot.nextLink")
+    return pd.DataFrame({"id": ids, "latitude": latitudes, "longitude": longitudes, **properties})
+
+def refresh_thing_catalog(path: str = THING_CATALOG_PATH) -> pd.DataFrame:
+    """
+    Fetch the catalog of Thing locations and replace the cached Parquet file atomically.
+    Meant to run as a scheduled job, e.g. `python spatial_index.py` from cron.
+    :param path: the Parquet file caching the catalog
+    :return: a dataframe with the id, latitude, longitude and properties of each Thing
+    """
+    catalog = fetch_thing_catalog()
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    catalog.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return catalog
+
+def load_thing_catalog(path: str = THING_CATALOG_PATH, max_age: float = THING_CATALOG_MAX_AGE) -> pd.DataFrame:
+    """
+    Load the cached catalog of Thing locations, fetching it again when it is missing or older than `max_age`.
+    :param path: the Parquet file caching the catalog
+    :param max_age: the maximum age of the cache in seconds
+    :return: a dataframe with the id, latitude, longitude and properties of each Thing
+    """
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+        return pd.read_parquet(path)
+    return refresh_thing_catalog(path)
+
+def _catalog_mtime(path: str) -> float:
+    """Get the modification time of the cached catalog, or 0 if it is missing."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+_thing_index: Optional[ThingIndex] = None
+_thing_index_loaded_at = 0.0  # modification time of the catalog the index was built from
+_thing_index_refresh_started_at: Optional[float] = None  # start of the running or last failed refresh
+_thing_index_lock = threading.Lock()
+
+def _refresh_thing_index(path: str, max_age: float) -> None:
+    """Rebuild the spatial index from the catalog, fetching it if it is stale, then swap it in."""
+    global _thing_index, _thing_index_loaded_at, _thing_index_refresh_started_at
+    try:
+        catalog = load_thing_catalog(path, max_age)
+        index = ThingIndex.from_catalog(catalog)
+    except Exception as e:
+        # The stale index keeps being served, the refresh is retried after THING_INDEX_RETRY_INTERVAL
+        print(f"[WARN] Refreshing the Thing catalog failed: {e}")
+        return
+    with _thing_index_lock:
+        _thing_index, _thing_index_loaded_at = index, _catalog_mtime(path)
+        _thing_index_refresh_started_at = None
+
+def get_thing_index(path: str = THING_CATALOG_PATH, max_age: float = THING_CATALOG_MAX_AGE) -> ThingIndex:
+    """
+    Get the process-wide spatial index over Thing locations. The catalog is never fetched by the caller:
+    once it is missing, older than `max_age`, or was replaced by the scheduled refresh job,
+    a single background thread rebuilds the index while the previous one keeps being served.
+    :param path: the Parquet file caching the catalog
+    :param max_age: the maximum age of the catalog in seconds
+    :return: the spatial index
+    :raises ThingCatalogUnavailableError: if no catalog was cached yet
+    """
+    global _thing_index, _thing_index_loaded_at, _thing_index_refresh_started_at
+    with _thing_index_lock:
+        if _thing_index is None and os.path.exists(path):
+            _thing_index, _thing_index_loaded_at = ThingIndex.from_catalog(pd.read_parquet(path)), _catalog_mtime(path)
+
+        now = time.time()
+        stale = _thing_index is None or now - _thing_index_loaded_at >= max_age \
+            or _catalog_mtime(path) > _thing_index_loaded_at
+        retry = _thing_index_refresh_started_at is None \
+            or now - _thing_index_refresh_started_at >= THING_INDEX_RETRY_INTERVAL
+        if stale and retry:
+            _thing_index_refresh_started_at = now
+            threading.Thread(target=_refresh_thing_index, args=(path, max_age),
+                             name="thing-index-refresh", daemon=True).start()
+
+        if _thing_index is None:
+            raise ThingCatalogUnavailableError(
+                "The spatial catalog of Things is not available yet, it is being fetched in the background. "
+                "Retry in a few minutes, or run `python spatial_index.py` to build it ahead of time.")
+        return _thing_index
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the cached catalog of USGS SensorThings Thing locations.")
+    parser.add_argument("--path", default=THING_CATALOG_PATH, help="the Parquet file caching the catalog")
+    args = parser.parse_args()
+
+    catalog = refresh_thing_catalog(args.path)
+    print(f"[INFO] Cached {len(catalog)} Things to {args.path}")
@@ -3,10 +3,20 @@
 Here's our first attempt at using data to create a table:
 """
 
-import numpy as np
-import pandas as pd
+import time
+
 import streamlit as st
-from langchain.llms import OpenAI
+from langchain_openai import OpenAI
+
+from agent import create_agent, run_agent
+from rate_limiter import get_openai_async_http_client, get_openai_http_client
+from serving import QueueFullError, get_worker_pool
+
+# Number of seconds between two polls of a running request
+POLL_INTERVAL = 0.5
+# Number of API keys whose LLM client and agent are kept, and number of seconds they are kept for
+RESOURCE_CACHE_MAX_ENTRIES = 32
+RESOURCE_CACHE_TTL = 3600
 
 st.title("Chatbots for USGS knowledge base Q&A using OpenAI ChatGPT-3.5")
 
@@ -18,9 +28,44 @@ with st.sidebar:
     chatbot_type = st.radio("**Select Chatbot**", ["Knowledge Base Q&A", "Agent"])
 
 
-def generate_response(input_text):
-    llm = OpenAI(temperature=0.7, openai_api_key=openai_api_key)
-    st.info(llm(input_text))
+# LLM clients and agents are created once per API key and shared by every session,
+# their calls go through the process-wide HTTP clients and openai rate limiter, which also handles retries
+@st.cache_resource(show_spinner=False, max_entries=RESOURCE_CACHE_MAX_ENTRIES, ttl=RESOURCE_CACHE_TTL)
+def get_llm(openai_api_key):
+    return OpenAI(
+        temperature=0.7,
+        openai_api_key=openai_api_key,
+        max_retries=0,
+        http_client=get_openai_http_client(),
+        http_async_client=get_openai_async_http_client(),
+    )
+
+
+@st.cache_resource(show_spinner=False, max_entries=RESOURCE_CACHE_MAX_ENTRIES, ttl=RESOURCE_CACHE_TTL)
+def get_agent(openai_api_key):
+    return create_agent(api_key=openai_api_key)
+
+
+def generate_response(llm, input_text):
+    return llm.invoke(input_text)
+
+
+def generate_agent_response(agent, tools, input_text):
+    return run_agent(input_text, agent=agent, tools=tools)["output"]
+
+
+def submit_request(input_text):
+    # Resources are resolved on the script thread, the worker only runs the request
+    if chatbot_type == "Agent":
+        agent, tools = get_agent(openai_api_key)
+        fn, args = generate_agent_response, (agent, tools, input_text)
+    else:
+        fn, args = generate_response, (get_llm(openai_api_key), input_text)
+
+    try:
+        st.session_state["job_id"] = get_worker_pool().submit(fn, *args)
+    except QueueFullError as e:
+        st.warning(str(e))
 
 
 with st.form("my_form"):
@@ -31,4 +76,21 @@ with st.form("my_form"):
     if not openai_api_key:
         st.info("Please add your OpenAI API key to continue.")
     elif submitted:
-        generate_response(text)
+        submit_request(text)
+
+# Poll the request of this session until the worker pool has finished it
+if "job_id" in st.session_state:
+    job = get_worker_pool().poll(st.session_state["job_id"])
+    if job["status"] in ("queued", "running"):
+        st.info("Your request is queued..." if job["status"] == "queued" else "Working on your request...")
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
+    del st.session_state["job_id"]
+    if job["status"] == "done":
+        st.session_state["response"] = job["result"]
+    else:
+        st.session_state["response"] = None
+        st.error(job["error"])
+
+if st.session_state.get("response"):
+    st.info(st.session_state["response"])
@@ -0,0 +1,176 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from langchain_core.agents import AgentAction, AgentFinish
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import tool
+import agent
+
+@tool
+def slow_tool(seconds: float) -> str:
+    """
+    Sleep for a number of seconds.
+    :param seconds: the number of seconds to sleep
+    :return: a message
+    """
+    time.sleep(seconds)
+    return f"slept {seconds}"
+
+def fake_agent(actions):
+    # Agent requesting all actions in the first turn, then finishing with the observations
+    def step(x):
+        if not x["intermediate_steps"]:
+            return actions
+        return AgentFinish(
+            return_values={"output": [observation for _, observation in x["intermediate_steps"]]},
+            log="")
+    return RunnableLambda(step)
+
+def fake_query_analyzer(stats):
+    # Query analyzer recording its calls and their concurrency, failing on questions about Mars
+    lock = threading.Lock()
+    stats.update(calls=[], running=0, max_running=0)
+
+    def analyze(question):
+        with lock:
+            stats["calls"].append(question)
+            stats["running"] += 1
+            stats["max_running"] = max(stats["max_running"], stats["running"])
+        try:
+            time.sleep(0.05)
+            if "mars" in question.lower():
+                raise ValueError("no USGS data on Mars")
+            state = "Ohio" if "ohio" in question.lower() else "Colorado"
+            observed_property = "Discharge" if "discharge" in question.lower() else None
+            return agent.ThingsSearchModel(state=state, observed_property=observed_property)
+        finally:
+            with lock:
+                stats["running"] -= 1
+    return RunnableLambda(analyze)
+
+class TestAgent(unittest.TestCase):
+
+    def test_run_agent_parallel_tool_calls(self):
+        actions = [AgentAction(tool="slow_tool", tool_input={"seconds": 0.5}, log="") for _ in range(4)]
+
+        # Run the agent with four tool calls in the same turn
+        start = time.monotonic()
+        result = agent.run_agent("question", agent=fake_agent(actions), tools=[slow_tool])
+        elapsed = time.monotonic() - start
+
+        # Check the tool calls ran at the same time and observations are in order
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(result["output"], ["slept 0.5"] * 4)
+        self.assertEqual([action for action, _ in result["intermediate_steps"]], actions)
+
+    def test_run_agent_tool_errors(self):
+        actions = [
+            AgentAction(tool="slow_tool", tool_input={"seconds": 0.5}, log=""),
+            AgentAction(tool="missing_tool", tool_input={}, log="")]
+
+        # Run the agent with a tool timeout shorter than the tool call
+        result = agent.run_agent("question", agent=fake_agent(actions), tools=[slow_tool], tool_timeout=0.1)
+
+        # Check the timeout and unknown tool are reported to the agent
+        self.assertEqual(result["output"], [
+            "Error: slow_tool timed out after 0.1 seconds.",
+            "missing_tool is not a valid tool, try one of [slow_tool]."])
+
+    def test_run_agent_abandoned_tool_threads(self):
+        actions = [AgentAction(tool="slow_tool", tool_input={"seconds": 0.3}, log="") for _ in range(20)]
+
+        # Run the agent several times with tool calls outliving their timeout, after a run starting the agent's threads
+        agent.run_agent("question", agent=fake_agent([]), tools=[slow_tool])
+        threads_before = set(threading.enumerate())
+        for _ in range(3):
+            agent.run_agent("question", agent=fake_agent(actions), tools=[slow_tool], tool_timeout=0.05)
+
+        # Check each run bounded its tool threads and they all exited once their calls returned
+        self.assertLessEqual(len(set(threading.enumerate()) - threads_before), 3 * agent.MAX_TOOL_WORKERS)
+        time.sleep(0.5)
+        self.assertEqual(set(threading.enumerate()) - threads_before, set())
+
+    def test_run_agent_budget(self):
+        # Agent which never finishes
+        looping_agent = RunnableLambda(
+            lambda x: [AgentAction(tool="slow_tool", tool_input={"seconds": 0}, log="")])
+
+        # Check the run stops after max_iterations turns
+        result = agent.run_agent("question", agent=looping_agent, tools=[slow_tool], max_iterations=3)
+        self.assertEqual(result["output"], "Agent stopped due to iteration limit or time limit.")
+        self.assertEqual(len(result["intermediate_steps"]), 3)
+
+        # Check the run stops once the latency budget is spent
+        start = time.monotonic()
+        result = agent.run_agent(
+            "question",
+            agent=fake_agent([AgentAction(tool="slow_tool", tool_input={"seconds": 2}, log="")]),
+            tools=[slow_tool],
+            max_latency=0.2)
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(result["output"], "Agent stopped due to iteration limit or time limit.")
+        self.assertEqual(result["intermediate_steps"], [])
+
+    def test_trim_intermediate_steps(self):
+        steps = [(AgentAction(tool="slow_tool", tool_input={"seconds": 0}, log=""), "a" * 4000) for _ in range(3)]
+
+        # Check the oldest outputs are trimmed first until the scratchpad fits the budget
+        result = agent.trim_intermediate_steps(steps, max_tokens=2000)
+        self.assertLessEqual(sum(agent.count_tokens(observation) for _, observation in result), 2000)
+        self.assertTrue(result[0][1].endswith("use get_stored_output to read it]"))
+        self.assertEqual(result[-1][1], "a" * 4000)
+
+        # Check the trimmed output can be read back
+        handle = result[0][1].split("handle '")[1].split("'")[0]
+        self.assertEqual(agent.get_stored_output.invoke({"handle": handle})[:100], "a" * 100)
+
+        # Check steps under budget are unchanged
+        self.assertEqual(agent.trim_intermediate_steps(steps[:1], max_tokens=2000), steps[:1])
+
+    @patch("agent.create_query_analyzer")
+    def test_batch_query_analysis(self, mock_create_query_analyzer):
+        stats = {}
+        mock_create_query_analyzer.return_value = fake_query_analyzer(stats)
+        queries = ["Wells in Ohio", "Streams in Colorado", "  wells in  OHIO ", "Wells on Mars"] + \
+                  [f"Wells in Colorado {i}" for i in range(6)]
+
+        result = agent.batch_query_analysis(queries, max_concurrency=3)
+
+        # Check duplicate questions are analyzed once and concurrency is bounded
+        self.assertEqual(len(stats["calls"]), 9)
+        self.assertEqual(stats["calls"].count("Wells in Ohio"), 1)
+        self.assertLessEqual(stats["max_running"], 3)
+
+        # Check results are in input order, duplicates share their result and failures are returned
+        self.assertEqual(result[0], agent.ThingsSearchModel(state="Ohio"))
+        self.assertEqual(result[1], agent.ThingsSearchModel(state="Colorado"))
+        self.assertIs(result[2], result[0])
+        self.assertIsInstance(result[3], ValueError)
+        self.assertEqual(len(result), len(queries))
+
+    @patch("query_analysis.fetch_observed_property_ids")
+    @patch("agent.create_query_analyzer")
+    def test_batch_generate_urls(self, mock_create_query_analyzer, mock_fetch):
+        mock_create_query_analyzer.return_value = fake_query_analyzer({})
+        mock_fetch.side_effect = ConnectionError("USGS is unavailable")
+
+        queries = ["Wells in Ohio", "Wells on Mars", "Discharge in Ohio", "wells in ohio"]
+        result = agent.batch_generate_urls(queries)
+
+        # Check each question gets a URL or its own error, in input order
+        self.assertEqual([item.question for item in result], queries)
+        self.assertEqual(result[0].url, "https://labs.waterdata.usgs.gov/sta/v1.1/Things"
+                         "?$filter=(properties/state eq 'Ohio')"
+                         "&$select=@iot.id,properties/state,properties/county,properties/active,"
+                         "properties/monitoringLocationType&$count=true")
+        self.assertIsNone(result[0].error)
+        self.assertEqual((result[1].search_params, result[1].url, result[1].error),
+                         (None, None, "no USGS data on Mars"))
+        self.assertEqual((result[2].search_params.observed_property, result[2].url, result[2].error),
+                         ("Discharge", None, "USGS is unavailable"))
+        self.assertEqual(result[3].url, result[0].url)
+        mock_fetch.assert_called_once_with("Discharge")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import api_utils
+
+class TestApiUtils(unittest.TestCase):
+
+    def setUp(self):
+        # SensorThings collection of 30 Things with navigation links
+        self.data = {
+            "@iot.count": 30,
+            "value": [
+                {
+                    "@iot.id": str(i),
+                    "@iot.selfLink": f"https://labs.waterdata.usgs.gov/sta/v1.1/Things('{i}')",
+                    "Datastreams@iot.navigationLink": f"https://labs.waterdata.usgs.gov/sta/v1.1/Things('{i}')/Datastreams",
+                    "properties": {"state": "Ohio", "county": "Franklin County"}
+                }
+                for i in range(30)]}
+
+    def test_project_fields(self):
+        # Check nested fields are kept for every entity of the collection
+        result = api_utils.project_fields(self.data, ["@iot.id", "properties/state", "missing/field"])
+        self.assertEqual(result["@iot.count"], 30)
+        self.assertEqual(result["value"][0], {"@iot.id": "0", "properties": {"state": "Ohio"}})
+
+    def test_compact_json(self):
+        # Check navigation links are dropped and lists are truncated
+        result = api_utils.compact_json(self.data, max_items=2)
+        self.assertEqual(result["value"], [
+            {"@iot.id": "0", "properties": {"state": "Ohio", "county": "Franklin County"}},
+            {"@iot.id": "1", "properties": {"state": "Ohio", "county": "Franklin County"}}])
+
+    def test_compact_tool_output(self):
+        # Check small outputs are returned whole without a handle
+        result = api_utils.compact_tool_output({"@iot.id": "0", "name": "Well"})
+        self.assertEqual(result, '{"@iot.id":"0","name":"Well"}')
+
+        # Check truncated outputs are stored and can be dereferenced
+        result = api_utils.compact_tool_output(self.data, fields=["@iot.id"])
+        self.assertIn("[truncated, full output stored as handle '", result)
+        handle = result.split("handle '")[1].split("'")[0]
+
+        page = api_utils.get_stored_output.invoke({"handle": handle, "path": "value", "offset": 28})
+        self.assertEqual(page, '{"total":30,"offset":28,"items":['
+                         '{"@iot.id":"28","properties":{"state":"Ohio","county":"Franklin County"}},'
+                         '{"@iot.id":"29","properties":{"state":"Ohio","county":"Franklin County"}}]}')
+        self.assertEqual(api_utils.get_stored_output.invoke({"handle": handle, "path": "value/3/properties/state"}),
+                         'Ohio')
+        self.assertTrue(api_utils.get_stored_output.invoke({"handle": handle, "path": "value/99"}).startswith("Error"))
+        self.assertTrue(api_utils.get_stored_output.invoke({"handle": "unknown"}).startswith("Error"))
+
+    def test_store_tool_output_bounded(self):
+        # Check only the most recent outputs are kept, including with concurrent writers
+        with api_utils.output_store_scope(api_utils.OutputStore(max_outputs=2)) as store:
+            handles = [api_utils.store_tool_output({"i": i}) for i in range(3)]
+            self.assertEqual(store.handles(), handles[1:])
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(lambda i: store.put({"i": i}), range(200)))
+            self.assertEqual(len(store.handles()), 2)
+
+    def test_output_store_scope(self):
+        # Check outputs stored within a scope, including from tools run in threads, are only visible within it
+        with api_utils.output_store_scope():
+            handle = api_utils.store_tool_output({"i": 0})
+            self.assertEqual(api_utils.get_stored_output.invoke({"handle": handle}), '{"i":0}')
+
+            async def read_from_tool_thread():
+                return await api_utils.get_stored_output.ainvoke({"handle": handle})
+            self.assertEqual(asyncio.run(read_from_tool_thread()), '{"i":0}')
+
+        with api_utils.output_store_scope():
+            self.assertTrue(api_utils.get_stored_output.invoke({"handle": handle}).startswith("Error"))
+        self.assertTrue(api_utils.get_stored_output.invoke({"handle": handle}).startswith("Error"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+import glob
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import pandas as pd
+import pyarrow.parquet as pq
+import requests
+import export
+from query_analysis import MAX_LOCATION_IDS, ThingsSearchModel
+from spatial_index import ThingIndex
+
+BASE = "https://labs.waterdata.usgs.gov/sta/v1.1"
+
+# Two pages of Things, the first Datastream's Observations being truncated to a second page
+PAGES = {
+    f"{BASE}/Things?$count=true": {
+        "@iot.count": 3,
+        "@iot.nextLink": f"{BASE}/Things?$skip=2",
+        "value": [
+            {
+                "@iot.id": "USGS-1",
+                "Datastreams@iot.navigationLink": f"{BASE}/Things('USGS-1')/Datastreams",
+                "properties": {"state": "Ohio"},
+                "Datastreams": [
+                    {
+                        "@iot.id": "ds-1",
+                        "description": "Discharge",
+                        "Observations@iot.nextLink": f"{BASE}/Datastreams('ds-1')/Observations?$skip=1",
+                        "Observations": [{"result": 1.0, "phenomenonTime": "2024-01-02"}],
+                    },
+                    {"@iot.id": "ds-2", "description": "Gage height", "Observations": []},
+                ],
+            },
+            {"@iot.id": "USGS-2", "properties": {"state": "Ohio"}, "Datastreams": []},
+        ],
+    },
+    f"{BASE}/Datastreams('ds-1')/Observations?$skip=1": {
+        "value": [{"result": 2.0, "phenomenonTime": "2024-01-01"}],
+    },
+    f"{BASE}/Things?$skip=2": {
+        "value": [{"@iot.id": "USGS-3", "properties": {"state": "Ohio", "county": "Franklin County", "hucCode": 5060001}}],
+    },
+}
+
+def mock_session(fail_on=None, error_status_on=None):
+    # Session serving PAGES, raising on the `fail_on` URL and answering 503 on the `error_status_on` URL
+    def get(url):
+        if url == fail_on:
+            raise ConnectionError(url)
+        response = MagicMock()
+        response.json.return_value = PAGES[url]
+        if url == error_status_on:
+            response.raise_for_status.side_effect = requests.HTTPError("503 Server Error")
+            response.json.return_value = {"message": "Service Unavailable"}
+        return response
+    session = MagicMock()
+    session.get.side_effect = get
+    return session
+
+def read_parts(output_dir, pattern):
+    # Read all part files in order
+    paths = sorted(glob.glob(os.path.join(output_dir, pattern)))
+    read = pd.read_parquet if pattern.endswith("parquet") else pd.read_csv
+    return pd.concat([read(path) for path in paths], ignore_index=True)
+
+class TestExport(unittest.TestCase):
+
+    def test_flatten_entity(self):
+        result = export.flatten_entity(PAGES[f"{BASE}/Things?$count=true"]["value"][0], "thing")
+        self.assertEqual(result, {"thing.@iot.id": "USGS-1", "thing.properties.state": "Ohio"})
+
+    @patch("export.get_usgs_session")
+    def test_export_query_results_parquet(self, mock_get_session):
+        mock_get_session.return_value = mock_session()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            manifest = export.export_query_results(
+                f"{BASE}/Things?$count=true", output_dir, max_rows_per_part=2, progress_callback=None)
+
+            # Check every page was walked and written in parts of at most 2 rows
+            self.assertTrue(manifest["complete"])
+            self.assertEqual((manifest["pages"], manifest["things"], manifest["rows"], manifest["total_things"]),
+                             (2, 3, 5, 3))
+            self.assertEqual(len(glob.glob(os.path.join(output_dir, "part-00000-*.parquet"))), 2)
+
+            df = read_parts(output_dir, "part-*.parquet")
+            self.assertEqual(list(df["thing.@iot.id"]), ["USGS-1", "USGS-1", "USGS-1", "USGS-2", "USGS-3"])
+            self.assertEqual(list(df["observation.result"][:2]), [1.0, 2.0])
+            self.assertEqual(df["datastream.description"][2], "Gage height")
+            self.assertEqual(df["thing.properties.county"][4], "Franklin County")
+
+    @patch("export.get_usgs_session")
+    def test_export_query_results_resume(self, mock_get_session):
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Interrupt the export on the second page of Things
+            mock_get_session.return_value = mock_session(fail_on=f"{BASE}/Things?$skip=2")
+            with self.assertRaises(ConnectionError):
+                export.export_query_results(
+                    f"{BASE}/Things?$count=true", output_dir, format="csv", progress_callback=None)
+
+            # Check the resumed export only fetches the remaining page
+            mock_get_session.return_value = mock_session()
+            manifest = export.export_query_results(
+                f"{BASE}/Things?$count=true", output_dir, format="csv", progress_callback=None)
+            mock_get_session.return_value.get.assert_called_once_with(f"{BASE}/Things?$skip=2")
+
+            self.assertEqual((manifest["pages"], manifest["rows"]), (2, 5))
+            df = read_parts(output_dir, "part-*.csv.gz")
+            self.assertEqual(len(df), 5)
+
+    @patch("export.get_usgs_session")
+    def test_export_query_results_schema(self, mock_get_session):
+        mock_get_session.return_value = mock_session()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            export.export_query_results(
+                f"{BASE}/Things?$count=true", output_dir, max_rows_per_part=2, progress_callback=None)
+
+            # Check the parts share one schema, although the county only appears on the last page
+            schemas = [pq.read_schema(path) for path in sorted(glob.glob(os.path.join(output_dir, "part-*.parquet")))]
+            self.assertEqual(len(schemas), 3)
+            for schema in schemas[1:]:
+                self.assertTrue(schema.equals(schemas[0]))
+
+            # Check the output directory reads as a single dataset, undeclared fields being kept as JSON
+            df = pd.read_parquet(output_dir)
+            self.assertEqual(list(df.columns), list(export.EXPORT_SCHEMA))
+            self.assertEqual(len(df), 5)
+            self.assertEqual(df["thing.properties.county"].dropna().tolist(), ["Franklin County"])
+            self.assertEqual(df["extra"].dropna().tolist(), ['{"thing.properties.hucCode": 5060001}'])
+
+    def test_to_record(self):
+        # Check values which do not fit their column dtype are moved to the extra column
+        record = export.to_record({"thing.@iot.id": "USGS-1", "observation.result": "Ice", "observation.@iot.id": 7,
+                                   "thing.properties.active": True})
+        self.assertEqual(record, {"thing.@iot.id": "USGS-1", "observation.@iot.id": 7,
+                                  "thing.properties.active": True, "extra": '{"observation.result": "Ice"}'})
+
+    @patch("export.get_usgs_session")
+    def test_export_query_results_error_status(self, mock_get_session):
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Check an error response on a page of Things stops the export before that page is recorded
+            mock_get_session.return_value = mock_session(error_status_on=f"{BASE}/Things?$skip=2")
+            with self.assertRaises(requests.HTTPError):
+                export.export_query_results(f"{BASE}/Things?$count=true", output_dir, progress_callback=None)
+            self.assertEqual(export._read_manifest(output_dir)["pages"], 1)
+
+            # Check an error response on a page of Observations is raised rather than exported as empty
+            mock_get_session.return_value = mock_session(error_status_on=f"{BASE}/Datastreams('ds-1')/Observations?$skip=1")
+            with self.assertRaises(requests.HTTPError):
+                export.export_query_results(
+                    f"{BASE}/Things?$count=true", output_dir, resume=False, progress_callback=None)
+
+    @patch("query_analysis.get_thing_index")
+    @patch("export.get_usgs_session")
+    def test_export_query_results_truncated_location(self, mock_get_session, mock_get_thing_index):
+        # Spatial index with more Things around the location than a location filter may hold
+        count = MAX_LOCATION_IDS + 50
+        mock_get_thing_index.return_value = ThingIndex(
+            [f"USGS-{i}" for i in range(count)], [35.78 + i * 0.001 for i in range(count)], [-78.64] * count)
+
+        # Check the export refuses to start rather than silently dropping the Things left out
+        search = ThingsSearchModel(latitude=35.78, longitude=-78.64, radius_miles=20)
+        with tempfile.TemporaryDirectory() as output_dir:
+            with self.assertRaises(ValueError) as context:
+                export.export_query_results(search, output_dir, progress_callback=None)
+            self.assertIn(f"100 nearest of the {count} matching things", str(context.exception))
+            self.assertEqual(os.listdir(output_dir), [])
+        mock_get_session.return_value.get.assert_not_called()
+
+    @patch("export.get_usgs_session")
+    def test_export_query_results_foreign_files(self, mock_get_session):
+        mock_get_session.return_value = mock_session()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Check a directory holding other files and no manifest is left untouched
+            with open(os.path.join(output_dir, "part-notes.txt"), "w") as f:
+                f.write("not an export")
+            with self.assertRaises(ValueError):
+                export.export_query_results(f"{BASE}/Things?$count=true", output_dir, progress_callback=None)
+            self.assertEqual(os.listdir(output_dir), ["part-notes.txt"])
+            mock_get_session.return_value.get.assert_not_called()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Check restarting an export only replaces the files of the previous export
+            export.export_query_results(f"{BASE}/Things?$count=true", output_dir, progress_callback=None)
+            manifest = export.export_query_results(
+                f"{BASE}/Things?$count=true", output_dir, format="csv", progress_callback=None)
+            self.assertTrue(manifest["complete"])
+            self.assertFalse(glob.glob(os.path.join(output_dir, "part-*.parquet")))
+            self.assertEqual(len(read_parts(output_dir, "part-*.csv.gz")), 5)
+
+    def test_export_query_results_invalid_format(self):
+        with self.assertRaises(ValueError):
+            export.export_query_results(f"{BASE}/Things", "unused", format="xlsx")
+
+if __name__ == '__main__':
+    unittest.main()
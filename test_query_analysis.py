@@ -1,5 +1,7 @@
 import unittest
+from unittest.mock import patch
 import query_analysis
+from spatial_index import ThingIndex
 
 class TestQueryAnalysis(unittest.TestCase):
 
@@ -129,5 +131,84 @@ class TestQueryAnalysis(unittest.TestCase):
 
         self.assertEqual(result, expected_url)
 
+    @patch("query_analysis.fetch_observed_property_ids")
+    def test_generate_urls(self, mock_fetch):
+        # Setup the mock ObservedProperties lookup, failing for one property
+        def fetch(observed_property):
+            if observed_property == 'Unknown':
+                raise KeyError('value')
+            return {'00060': 'Discharge, cubic feet per second'}
+        mock_fetch.side_effect = fetch
+
+        search_params_list = [
+            query_analysis.ThingsSearchModel(state='CA', observed_property='Discharge'),
+            query_analysis.ThingsSearchModel(state='CA'),
+            query_analysis.ThingsSearchModel(state='NC', observed_property='Discharge'),
+            query_analysis.ThingsSearchModel(state='NC', observed_property='Unknown')]
+
+        # Call the generate_urls function
+        result = query_analysis.generate_urls(search_params_list)
+
+        # Check that shared lookups are only done once
+        self.assertEqual(mock_fetch.call_count, 2)
+
+        # Check the results are in input order with per-item errors
+        for search_params, url in zip(search_params_list[:3], result[:3]):
+            search_url = query_analysis.ThingsSearchUrl(
+                search_params, observed_property_ids={'00060': 'Discharge, cubic feet per second'})
+            search_url.construct_url()
+            self.assertEqual(url, search_url.url)
+        self.assertIsInstance(result[3], KeyError)
+
+    def test_get_location_filter_str(self):
+        # Create a spatial index with two Things near Raleigh and one in Charlotte
+        index = ThingIndex(['USGS-1', 'USGS-2', 'USGS-3'], [35.90, 35.78, 35.23], [-78.70, -78.64, -80.84])
+
+        # Things within 20 miles, nearest first
+        search_params = query_analysis.ThingsSearchModel(latitude=35.78, longitude=-78.64, radius_miles=20)
+        search_url = query_analysis.ThingsSearchUrl(search_params, spatial_index=index)
+        self.assertEqual(search_url.get_location_filter_str(), "(@iot.id eq 'USGS-2' or @iot.id eq 'USGS-1')")
+
+        # Nearest Thing
+        search_params = query_analysis.ThingsSearchModel(latitude=35.78, longitude=-78.64, nearest_count=1)
+        search_url = query_analysis.ThingsSearchUrl(search_params, spatial_index=index)
+        self.assertEqual(search_url.get_location_filter_str(), "(@iot.id eq 'USGS-2')")
+
+        # No Thing within the radius
+        search_params = query_analysis.ThingsSearchModel(latitude=40.0, longitude=-100.0, radius_miles=1)
+        search_url = query_analysis.ThingsSearchUrl(search_params, spatial_index=index)
+        self.assertEqual(search_url.get_location_filter_str(), "@iot.id eq ''")
+
+        # Location combined with the other filters
+        search_params = query_analysis.ThingsSearchModel(
+                state='North Carolina', latitude=35.78, longitude=-78.64, nearest_count=1)
+        search_url = query_analysis.ThingsSearchUrl(search_params, spatial_index=index)
+        self.assertEqual(search_url.get_and_filter_str(),
+                         "(properties/state eq 'North Carolina' and (@iot.id eq 'USGS-2'))")
+
+    def test_get_location_ids_truncated(self):
+        # Create a spatial index with 150 Things within 20 miles of Raleigh, every other one being a Well
+        latitudes = [35.78 + i * 0.001 for i in range(150)]
+        types = ['Stream' if i % 2 == 0 else 'Well' for i in range(150)]
+        index = ThingIndex([f'USGS-{i}' for i in range(150)], latitudes, [-78.64] * 150,
+                           properties={'monitoring_location_type': types, 'state': ['North Carolina'] * 150})
+
+        # Check the matching Things beyond MAX_LOCATION_IDS are left out and the caller is told
+        search_params = query_analysis.ThingsSearchModel(latitude=35.78, longitude=-78.64, radius_miles=20)
+        search_url = query_analysis.ThingsSearchUrl(search_params, spatial_index=index)
+        search_url.construct_url()
+        self.assertEqual(search_url.get_location_ids(), [f'USGS-{i}' for i in range(100)])
+        self.assertEqual(search_url.location_match_count, 150)
+        self.assertIn("100 nearest of the 150 matching things", search_url.get_location_note())
+
+        # Check the other criteria are applied before truncating, so every matching Stream is kept
+        search_params = query_analysis.ThingsSearchModel(
+                state='North Carolina', monitoring_location_type='Stream',
+                latitude=35.78, longitude=-78.64, radius_miles=20)
+        search_url = query_analysis.ThingsSearchUrl(search_params, spatial_index=index)
+        search_url.construct_url()
+        self.assertEqual(search_url.get_location_ids(), [f'USGS-{i}' for i in range(0, 150, 2)])
+        self.assertIsNone(search_url.get_location_note())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,125 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+import httpx
+import requests
+import rate_limiter
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_token_bucket(self):
+        # Bucket of 2 tokens refilled at 10 tokens per second
+        bucket = rate_limiter.TokenBucket(rate=10, capacity=2)
+
+        # Check the burst is free and the next reservation waits for the refill
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertAlmostEqual(bucket.reserve(1), 0.1, places=2)
+
+        # Check a reservation larger than the capacity is charged in full
+        bucket = rate_limiter.TokenBucket(rate=10, capacity=2)
+        self.assertAlmostEqual(bucket.reserve(5), 0.3, places=2)
+        self.assertAlmostEqual(bucket.reserve(1), 0.4, places=2)
+
+    def test_aimd_concurrency(self):
+        limiter = rate_limiter.RateLimiter("test", requests_per_minute=60000, max_concurrency=8)
+
+        # Check a 429 halves the concurrency limit and blocks new calls for Retry-After seconds
+        limiter.acquire()
+        limiter.release(429, retry_after=5)
+        self.assertEqual(limiter.concurrency_limit, 4)
+        self.assertGreater(limiter.blocked_until, 0)
+
+        # Check successes increase the concurrency limit additively
+        with patch.object(limiter, "blocked_until", 0.0):
+            for _ in range(4):
+                limiter.acquire()
+                limiter.release(200)
+        self.assertAlmostEqual(limiter.concurrency_limit, 4.92, places=2)
+
+        stats = limiter.stats()
+        self.assertEqual((stats["requests"], stats["successes"], stats["throttled"]), (5, 4, 1))
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_circuit_breaker(self):
+        limiter = rate_limiter.RateLimiter("test", requests_per_minute=60000, failure_threshold=2, reset_timeout=30)
+
+        # Check the circuit opens after consecutive failures
+        for _ in range(2):
+            limiter.acquire()
+            limiter.release(503)
+        self.assertEqual(limiter.stats()["circuit"], "open")
+        with self.assertRaises(rate_limiter.CircuitOpenError):
+            limiter.acquire()
+
+        # Check a single trial call goes through once half-open, and its success closes the circuit
+        limiter.opened_at -= 30
+        self.assertEqual(limiter.stats()["circuit"], "half-open")
+        limiter.acquire()
+        with self.assertRaises(rate_limiter.CircuitOpenError):
+            limiter.acquire()
+        limiter.release(200)
+        self.assertEqual(limiter.stats()["circuit"], "closed")
+        self.assertEqual(limiter.stats()["rejected"], 2)
+
+    @patch("rate_limiter.time.sleep")
+    def test_rate_limited_transport(self, mock_sleep):
+        limiter = rate_limiter.RateLimiter("test", requests_per_minute=60000)
+        responses = iter([
+            httpx.Response(429, headers={"Retry-After": "2"}),
+            httpx.Response(200, json={"ok": True})])
+        transport = rate_limiter.RateLimitedTransport(
+            limiter, httpx.MockTransport(lambda request: next(responses)))
+
+        # Check the throttled request is retried after at least Retry-After seconds
+        with httpx.Client(transport=transport) as client:
+            response = client.post("https://api.openai.com/v1/chat/completions", json={"messages": []})
+        self.assertEqual(response.json(), {"ok": True})
+        self.assertGreaterEqual(max(call.args[0] for call in mock_sleep.call_args_list), 2)
+        self.assertEqual(limiter.stats()["retries"], 1)
+        self.assertEqual(limiter.stats()["throttled"], 1)
+
+    def test_cancelled_call_frees_slot(self):
+        limiter = rate_limiter.RateLimiter("test", requests_per_minute=60000, failure_threshold=1)
+
+        async def slow_response(request):
+            await asyncio.sleep(10)
+            return httpx.Response(200)
+
+        async def call():
+            transport = rate_limiter.AsyncRateLimitedTransport(limiter, httpx.MockTransport(slow_response))
+            async with httpx.AsyncClient(transport=transport) as client:
+                await asyncio.wait_for(client.get("https://api.openai.com/v1/models"), timeout=0.05)
+
+        # Check a cancelled call gives its slot back without being counted as a failure
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(call())
+        self.assertEqual(limiter.stats()["in_flight"], 0)
+        self.assertEqual(limiter.stats()["circuit"], "closed")
+
+        # Check a call cancelled while waiting for the rate limit gives its slot back too
+        async def wait_for_bucket():
+            with patch.object(limiter.request_bucket, "reserve", return_value=10):
+                await asyncio.wait_for(limiter.aacquire(), timeout=0.05)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(wait_for_bucket())
+        self.assertEqual(limiter.stats()["in_flight"], 0)
+
+    @patch("rate_limiter.time.sleep")
+    def test_rate_limited_adapter_read_timeout(self, mock_sleep):
+        limiter = rate_limiter.RateLimiter("test", requests_per_minute=60000, max_attempts=2)
+        session = requests.Session()
+        session.mount("https://", rate_limiter.RateLimitedAdapter(limiter))
+
+        # Check a read timeout is retried, re-raised on the last attempt and frees the slot every time
+        with patch("rate_limiter.HTTPAdapter.send", side_effect=requests.ReadTimeout("timed out")) as mock_send:
+            with self.assertRaises(requests.ReadTimeout):
+                session.get("https://labs.waterdata.usgs.gov/sta/v1.1/Things")
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertEqual(mock_send.call_args.kwargs["timeout"], rate_limiter.DEFAULT_TIMEOUT)
+        self.assertEqual(limiter.stats()["in_flight"], 0)
+        self.assertEqual(limiter.stats()["retries"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+import serving
+
+class TestServing(unittest.TestCase):
+
+    def wait(self, pool, job_id):
+        # Poll a job until it is finished
+        while True:
+            job = pool.poll(job_id)
+            if job["status"] not in ("queued", "running"):
+                return job
+            time.sleep(0.01)
+
+    def test_submit_and_poll(self):
+        pool = serving.WorkerPool(max_workers=2)
+
+        # Check results are returned to the submitting session and forgotten once polled
+        job_ids = [pool.submit(lambda x: x * 2, i) for i in range(5)]
+        self.assertEqual([self.wait(pool, job_id)["result"] for job_id in job_ids], [0, 2, 4, 6, 8])
+        self.assertEqual(pool.poll(job_ids[0])["status"], "unknown")
+
+        # Check errors are reported per job
+        job = self.wait(pool, pool.submit(lambda: 1 / 0))
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"], "division by zero")
+        self.assertEqual(pool.stats(), {
+            "submitted": 6, "completed": 5, "failed": 1, "rejected": 0, "expired": 0, "pending": 0})
+
+    def test_queue_full(self):
+        pool = serving.WorkerPool(max_workers=1, max_pending=2)
+        release = threading.Event()
+
+        # Check submissions are rejected while max_pending jobs are queued or running
+        job_ids = [pool.submit(release.wait) for _ in range(2)]
+        with self.assertRaises(serving.QueueFullError):
+            pool.submit(release.wait)
+        self.assertEqual(pool.poll(job_ids[1])["status"], "queued")
+
+        release.set()
+        for job_id in job_ids:
+            self.assertEqual(self.wait(pool, job_id)["status"], "done")
+        self.assertEqual(pool.stats()["rejected"], 1)
+
+    def test_result_ttl(self):
+        pool = serving.WorkerPool(max_workers=1, result_ttl=0)
+
+        # Check finished jobs which are never polled expire
+        job_id = pool.submit(lambda: None)
+        while pool.stats()["pending"]:
+            time.sleep(0.01)
+        time.sleep(0.01)
+        pool.submit(lambda: None)
+        self.assertEqual(pool.poll(job_id)["status"], "unknown")
+        self.assertEqual(pool.stats()["expired"], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import numpy as np
+import pandas as pd
+import requests
+import spatial_index
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        # Random Things around North Carolina plus a few known ones near Raleigh
+        rng = np.random.default_rng(0)
+        self.latitudes = np.concatenate([[35.78, 35.90, 36.10], rng.uniform(33.8, 36.6, 5000)])
+        self.longitudes = np.concatenate([[-78.64, -78.70, -79.00], rng.uniform(-84.3, -75.5, 5000)])
+        self.ids = [f"USGS-{i}" for i in range(len(self.latitudes))]
+        self.index = spatial_index.ThingIndex(self.ids, self.latitudes, self.longitudes)
+
+    def brute_force(self, lat, lon):
+        # Distances to every Thing, nearest first
+        distances = spatial_index.haversine_miles(lat, lon, self.latitudes, self.longitudes)
+        return [(self.ids[i], distances[i]) for i in np.argsort(distances, kind="stable")], distances
+
+    def test_haversine_miles(self):
+        # Raleigh to Durham is about 21 miles
+        distance = spatial_index.haversine_miles(35.78, -78.64, np.array([35.99]), np.array([-78.90]))[0]
+        self.assertAlmostEqual(distance, 20.6, delta=0.5)
+
+    def test_query_radius(self):
+        # Check the index matches a brute force scan
+        expected, distances = self.brute_force(35.78, -78.64)
+        result = self.index.query_radius(35.78, -78.64, 20)
+        self.assertEqual([id for id, _ in result], [id for id, _ in expected[:int(np.sum(distances <= 20))]])
+        self.assertEqual(result[0], ("USGS-0", 0.0))
+
+    def test_nearest(self):
+        # Check the index matches a brute force scan, including beyond the initial search radius
+        expected, _ = self.brute_force(35.78, -78.64)
+        for k in [1, 10, 500]:
+            result = self.index.nearest(35.78, -78.64, k)
+            self.assertEqual([id for id, _ in result], [id for id, _ in expected[:k]])
+        # Check a search far from every Thing still returns k Things
+        self.assertEqual(len(self.index.nearest(47.6, -122.3, 3)), 3)
+
+    def test_where(self):
+        # Check property filters match a brute force scan
+        index = spatial_index.ThingIndex.from_catalog(pd.DataFrame({
+            "id": self.ids, "latitude": self.latitudes, "longitude": self.longitudes,
+            "active": [i % 3 == 0 for i in range(len(self.ids))]}))
+        expected, _ = self.brute_force(35.78, -78.64)
+        expected = [id for id, _ in expected if int(id.split("-")[1]) % 3 == 0]
+        result = index.nearest(35.78, -78.64, 50, where={"active": True, "county": "Wake County"})
+        self.assertEqual([id for id, _ in result], expected[:50])
+
+    def test_query_bbox(self):
+        result = self.index.query_bbox(35.5, -79.0, 36.0, -78.5)
+        expected = [id for id, lat, lon in zip(self.ids, self.latitudes, self.longitudes)
+                    if 35.5 <= lat <= 36.0 and -79.0 <= lon <= -78.5]
+        self.assertEqual(sorted(result), sorted(expected))
+
+    @patch("spatial_index.get_usgs_session")
+    def test_fetch_thing_catalog(self, mock_get_session):
+        first_page, second_page = MagicMock(), MagicMock()
+        first_page.json.return_value = {
+            "@iot.nextLink": "next",
+            "value": [{"@iot.id": "USGS-0", "properties": {"state": "North Carolina", "active": True},
+                       "Locations": [{"location": {"type": "Point", "coordinates": [-78.64, 35.78]}}]}]}
+        second_page.raise_for_status.side_effect = requests.HTTPError("503 Server Error")
+        mock_get_session.return_value.get.side_effect = [first_page, second_page]
+
+        # Check an error page is raised rather than caching a partial catalog
+        with self.assertRaises(requests.HTTPError):
+            spatial_index.fetch_thing_catalog("first")
+
+        mock_get_session.return_value.get.side_effect = [first_page]
+        first_page.json.return_value["@iot.nextLink"] = None
+        catalog = spatial_index.fetch_thing_catalog("first")
+        self.assertEqual(catalog.iloc[0].to_dict(), {
+            "id": "USGS-0", "latitude": 35.78, "longitude": -78.64, "state": "North Carolina",
+            "county": None, "active": True, "monitoring_location_type": None})
+
+    @patch("spatial_index.fetch_thing_catalog")
+    def test_load_thing_catalog(self, mock_fetch):
+        mock_fetch.return_value = pd.DataFrame({"id": ["USGS-0"], "latitude": [35.78], "longitude": [-78.64]})
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "thing_catalog.parquet")
+
+            # Check the catalog is fetched once and then read from the cache
+            spatial_index.load_thing_catalog(path)
+            catalog = spatial_index.load_thing_catalog(path)
+            self.assertEqual(mock_fetch.call_count, 1)
+            self.assertEqual(list(catalog["id"]), ["USGS-0"])
+
+            # Check a stale cache is refreshed
+            stale = time.time() - spatial_index.THING_CATALOG_MAX_AGE - 1
+            os.utime(path, (stale, stale))
+            spatial_index.load_thing_catalog(path)
+            self.assertEqual(mock_fetch.call_count, 2)
+
+    @patch("spatial_index._thing_index_refresh_started_at", None)
+    @patch("spatial_index._thing_index_loaded_at", 0.0)
+    @patch("spatial_index._thing_index", None)
+    @patch("spatial_index.fetch_thing_catalog")
+    def test_get_thing_index(self, mock_fetch):
+        fetch_started, fetch_release = threading.Event(), threading.Event()
+
+        def fetch():
+            fetch_started.set()
+            fetch_release.wait(5)
+            return pd.DataFrame({"id": ["USGS-1"], "latitude": [35.90], "longitude": [-78.70]})
+        mock_fetch.side_effect = fetch
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "thing_catalog.parquet")
+            pd.DataFrame({"id": ["USGS-0"], "latitude": [35.78], "longitude": [-78.64]}).to_parquet(path)
+            stale = time.time() - spatial_index.THING_CATALOG_MAX_AGE - 1
+            os.utime(path, (stale, stale))
+
+            # Check the stale index is served while a single background refresh fetches the catalog
+            index = spatial_index.get_thing_index(path)
+            self.assertTrue(fetch_started.wait(5))
+            for _ in range(3):
+                self.assertIs(spatial_index.get_thing_index(path), index)
+            self.assertEqual(list(index.ids), ["USGS-0"])
+            self.assertEqual(mock_fetch.call_count, 1)
+
+            # Check the refreshed index is swapped in once the catalog is fetched
+            fetch_release.set()
+            for thread in threading.enumerate():
+                if thread.name == "thing-index-refresh":
+                    thread.join(5)
+            self.assertEqual(list(spatial_index.get_thing_index(path).ids), ["USGS-1"])
+            self.assertEqual(mock_fetch.call_count, 1)
+
+    @patch("spatial_index._thing_index_refresh_started_at", None)
+    @patch("spatial_index._thing_index_loaded_at", 0.0)
+    @patch("spatial_index._thing_index", None)
+    @patch("spatial_index.fetch_thing_catalog")
+    def test_get_thing_index_cold_start(self, mock_fetch):
+        fetch_release = threading.Event()
+
+        def fetch():
+            fetch_release.wait(5)
+            return pd.DataFrame({"id": ["USGS-0"], "latitude": [35.78], "longitude": [-78.64]})
+        mock_fetch.side_effect = fetch
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "thing_catalog.parquet")
+
+            # Check callers get an error right away while a single background refresh fetches the catalog
+            for _ in range(3):
+                start = time.monotonic()
+                with self.assertRaises(spatial_index.ThingCatalogUnavailableError):
+                    spatial_index.get_thing_index(path)
+                self.assertLess(time.monotonic() - start, 1)
+
+            # Check the index is served once the catalog is fetched
+            fetch_release.set()
+            for thread in threading.enumerate():
+                if thread.name == "thing-index-refresh":
+                    thread.join(5)
+            self.assertEqual(list(spatial_index.get_thing_index(path).ids), ["USGS-0"])
+            self.assertEqual(mock_fetch.call_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
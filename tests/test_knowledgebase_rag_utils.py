@@ -1,7 +1,8 @@
+import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
-from unstructured.documents.elements import Element
+from unstructured.documents.elements import CompositeElement, Element
 
 import knowledgebase_rag.utils as utils
 
@@ -50,6 +51,68 @@ class TestKnowledgeRAGUtils(unittest.TestCase):
         with self.assertRaises(ValueError):
             utils.find_pages_from_base(None)
 
+    def test_canonicalize_url(self):
+        # Test that scheme and host case, default port, fragment, trailing slash and query order are normalized
+        url = utils.canonicalize_url("HTTPS://WaterServices.USGS.gov:443/docs/dv-service?b=2&a=1#top")
+        self.assertEqual(url, "https://waterservices.usgs.gov/docs/dv-service/?a=1&b=2")
+        # Test that an already canonical URL is unchanged
+        self.assertEqual(utils.canonicalize_url(url), url)
+
+    def test_extract_links(self):
+        # Test that only anchors with an href are returned
+        content = b'<html><head><link href="/style.css"></head><body>' \
+            b'<a href="/docs/a/">A</a><a name="x">X</a><p><a href="b/">B</a></p></body></html>'
+        self.assertEqual(utils.extract_links(content), ["/docs/a/", "b/"])
+
+    @patch("knowledgebase_rag.utils.requests.Session")
+    def test_crawl_link_graph(self, mock_session):
+
+        # Setup the mock session serving a small site with duplicate and out of scope links
+        site = {
+            "https://example.com/docs/": b'<a href="/docs/a">A</a><a href="b/">B</a>'
+            b'<a href="/docs/a/#top">A</a><a href="https://other.com/docs/">O</a><a href="/about/">About</a>',
+            "https://example.com/docs/a/": b'<a href="/docs/">Home</a><a href="/docs/b/">B</a>',
+            "https://example.com/docs/b/": b'<a href="/docs/a/">A</a>',
+        }
+
+        # URLs redirected by the server to the URL actually served
+        redirects = {}
+
+        def get(url, timeout):
+            page = MagicMock()
+            page.content = site[url]
+            page.headers = {"Content-Type": "text/html"}
+            page.url = redirects.get(url, url)
+            return page
+
+        mock_session.return_value.get.side_effect = get
+
+        # Test that every page is visited once, breadth first
+        pages, stats = utils.crawl_link_graph("https://example.com/docs/")
+        self.assertEqual(pages, list(site))
+        self.assertEqual(mock_session.return_value.get.call_count, 3)
+        # Test the link graph statistics
+        self.assertEqual(stats["pages_visited"], 3)
+        self.assertEqual(stats["links_found"], 8)
+        self.assertEqual(stats["edges"], 5)
+        self.assertEqual(stats["unique_urls"], 3)
+        self.assertEqual(stats["most_linked"][0], ("https://example.com/docs/a/", 2))
+
+        # Test that max_pages bounds the crawl
+        pages, stats = utils.crawl_link_graph("https://example.com/docs/", max_pages=1)
+        self.assertEqual(pages, ["https://example.com/docs/"])
+        self.assertEqual(stats["frontier_remaining"], 2)
+
+        # Test that relative links resolve against the redirected URL rather than the canonical one
+        site = {
+            "https://example.com/docs/": b'<a href="dv-service">DV</a>',
+            "https://example.com/docs/dv-service/": b'<a href="examples">Examples</a>',
+            "https://example.com/docs/examples/": b"",
+        }
+        redirects["https://example.com/docs/dv-service/"] = "https://example.com/docs/dv-service"
+        pages, _ = utils.crawl_link_graph("https://example.com/docs/")
+        self.assertEqual(pages, list(site))
+
     @patch("knowledgebase_rag.utils.OpenAIEmbeddingEncoder")
     def test_unstructured_page_processing(self, mock_encoder):
 
@@ -65,6 +128,38 @@ class TestKnowledgeRAGUtils(unittest.TestCase):
         # Test with a valid URL, check if the length of the list is greater than 0
         self.assertEqual(len(embeddings), 1536)
 
+    def test_deduplicate_chunks(self):
+        # Set up test harness: a boilerplate footer repeated across pages
+        footer = (
+            "U.S. Department of the Interior | U.S. Geological Survey "
+            "Page Contact Information: Water Data Support Team Page Last Modified"
+        )
+        text = "The daily values service provides statistics for a site over a day."
+        chunks = []
+        for i, chunk_text in enumerate(
+            [footer, text, footer, footer.upper(), footer + " 2024"]
+        ):
+            chunk = CompositeElement(text=chunk_text)
+            chunk.metadata.url = f"https://example.com/page{i}/"
+            chunks.append(chunk)
+
+        # Test that exact and near-duplicates are removed, keeping the first occurrence
+        deduped = utils.deduplicate_chunks(chunks)
+        self.assertEqual([chunk.text for chunk in deduped], [footer, text])
+        # Test that the canonical chunk keeps the URLs of its duplicates
+        self.assertEqual(
+            deduped[0].metadata.source_urls,
+            [f"https://example.com/page{i}/" for i in [0, 2, 3, 4]],
+        )
+        self.assertEqual(
+            deduped[1].metadata.source_urls, ["https://example.com/page1/"]
+        )
+
+    def test_deduplicate_chunks_invalid(self):
+        # Test with a number of permutations not divisible by the number of bands
+        with self.assertRaises(ValueError):
+            utils.deduplicate_chunks([], num_perm=64, bands=5)
+
     @patch("knowledgebase_rag.utils.Pinecone")
     def test_update_embeddings_in_pinecone(self, mock_pinecone):
 
@@ -85,5 +180,27 @@ class TestKnowledgeRAGUtils(unittest.TestCase):
         self.assertIsNone(utils.update_embeddings_in_pinecone(embeddings))
 
 
+    @patch("knowledgebase_rag.utils.Pinecone")
+    def test_update_embeddings_in_pinecone_source_urls(self, mock_pinecone):
+        # Set up test harness: a footer repeated on every page of a large crawl
+        chunks = []
+        for i in range(1000):
+            chunk = CompositeElement(text="U.S. Department of the Interior | U.S. Geological Survey")
+            chunk.metadata.url = f"https://waterservices.usgs.gov/docs/statistics/page-{i:04d}/"
+            chunks.append(chunk)
+        embeddings = utils.deduplicate_chunks(chunks)
+        embeddings[0].embeddings = [0] * 1536
+
+        utils.update_embeddings_in_pinecone(embeddings)
+
+        # Test that the stored source URLs are capped and the metadata fits the Pinecone limit
+        index = mock_pinecone.return_value.Index.return_value
+        metadata = index.upsert.call_args.kwargs["vectors"][0]["metadata"]
+        self.assertEqual(len(metadata["source_urls"]), utils.MAX_METADATA_SOURCE_URLS)
+        self.assertEqual(metadata["source_urls"][0], chunks[0].metadata.url)
+        self.assertEqual(metadata["source_url_count"], 1000)
+        self.assertLess(len(json.dumps(metadata)), 40 * 1024)
+
+
 if __name__ == "__main__":
     unittest.main()